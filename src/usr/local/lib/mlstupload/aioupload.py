@@ -0,0 +1,681 @@
+#! /usr/bin/python3
+
+"""Asyncio upload engine, used in place of the worker threads
+
+With [cloud] engine = asyncio, the tasks of upload.QUEUE are run on a
+single event loop, with at most [cloud] workers files and [cloud]
+parallel_chunks blocks of each file in flight. Requests are sent by a
+minimal HTTP/1.1 client on asyncio streams. The upload journal, QUOTA,
+SIZER and the bandwidth limiter are shared with the threaded engine.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import ssl
+import sys
+import time
+import traceback
+import urllib.parse as up
+import zlib
+
+from . import common
+from . import upload
+
+
+class Response:
+    "Status, headers and body of an HTTP response"
+    __slots__ = ("status", "headers", "data")
+
+    def __init__(self, status: int, headers: dict, data: bytes):
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+
+class AsyncHTTP:
+    """HTTP/1.1 client on asyncio streams
+
+Connections are kept alive and reused unless [cloud] keep_alive is off,
+with at most limit connections open to each host, and counted in
+common.METRICS[name] like the pools of WebRequest. A request failing on
+a network error is sent again on a new connection up to attempt times,
+then ProtocolError of urllib3 is raised as the threaded engine would.
+As with the Retry of urllib3, methods other than IDEMPOTENT are only sent
+again if they failed to connect, never once written.
+"""
+    IDEMPOTENT = common.urllib3.Retry.DEFAULT_ALLOWED_METHODS
+
+    def __init__(self, name: str, limit: int, attempt: int):
+        self.name = name
+        self.limit = limit
+        self.attempt = attempt
+        self.connect_timeout, self.read_timeout = common.pool_settings(
+            common.CONFIG
+        )[3:]
+        self.keep_alive = common.CONFIG["cloud"].getboolean("keep_alive")
+        self.idle = {}
+        self.slots = {}
+        self.context = ssl.create_default_context()
+
+    async def _connect(self, key: tuple) -> tuple:
+        "Open a new connection to (scheme, host, port)"
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                key[1], key[2],
+                ssl=self.context if key[0] == "https" else None
+            ),
+            self.connect_timeout
+        )
+
+    @staticmethod
+    async def _read_response(reader, method: str) -> tuple:
+        "Read a response, return it with whether the connection is reusable"
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(b"", None)
+        version, status = line.decode("latin-1").split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        keep = (
+            headers.get("connection", "").lower() != "close"
+            if version == "HTTP/1.1"
+            else headers.get("connection", "").lower() == "keep-alive"
+        )
+        if method == "HEAD" or status in ("204", "304"):
+            data = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    # Skip the trailer
+                    while (await reader.readline()) not in (
+                        b"\r\n", b"\n", b""
+                    ):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b"".join(chunks)
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            # Delimited by the end of the connection
+            data = await reader.read()
+            keep = False
+        return Response(int(status), headers, data), keep
+
+    async def request(
+        self, method: str, url: str, body=b"", headers=None
+    ) -> Response:
+        """Send a request and read the whole response
+
+The body may be bytes or a tuple of bytes-like parts, as returned by
+common.multipart_body.
+"""
+        target = up.urlsplit(url)
+        key = (
+            target.scheme, target.hostname,
+            target.port or (443 if target.scheme == "https" else 80)
+        )
+        path = (target.path or "/") + (
+            "?"+target.query if target.query else ""
+        )
+        parts = body if isinstance(body, tuple) else (body,)
+        length = sum(memoryview(item).nbytes for item in parts)
+        head = {
+            "Host": target.netloc,
+            "User-Agent": common.WebRequest.USER_AGENT,
+            "Content-Length": str(length)
+        }
+        if not self.keep_alive:
+            head["Connection"] = "close"
+        head.update(headers or {})
+        data = (
+            method+" "+path+" HTTP/1.1\r\n"
+            + "".join(item[0]+": "+item[1]+"\r\n" for item in head.items())
+            + "\r\n"
+        ).encode("latin-1")
+        if key not in self.slots:
+            self.slots[key] = asyncio.Semaphore(self.limit)
+        async with self.slots[key]:
+            failed = 0
+            while True:
+                idle = self.idle.get(key)
+                conn = idle.pop() if idle else None
+                if conn is not None and (
+                    conn[0].at_eof() or conn[1].is_closing()
+                ):
+                    # Dropped by the server while idle
+                    conn[1].close()
+                    continue
+                reused = conn is not None
+                common.count_connection(self.name, reused)
+                written = False
+                try:
+                    if conn is None:
+                        conn = await self._connect(key)
+                    written = True
+                    conn[1].write(data)
+                    for item in parts:
+                        conn[1].write(item)
+                    await asyncio.wait_for(
+                        conn[1].drain(), self.read_timeout
+                    )
+                    resp, keep = await asyncio.wait_for(
+                        self._read_response(conn[0], method),
+                        self.read_timeout
+                    )
+                except (
+                    OSError, ValueError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError
+                ) as err:
+                    if conn is not None:
+                        conn[1].close()
+                    if not reused:
+                        # Closed idle connections are not counted
+                        failed += 1
+                    if failed > self.attempt or (
+                        written and method not in AsyncHTTP.IDEMPOTENT
+                    ):
+                        raise common.urllib3.exceptions.ProtocolError(
+                            "Connection aborted.", err
+                        ) from err
+                    continue
+                if keep and self.keep_alive:
+                    self.idle.setdefault(key, []).append(conn)
+                else:
+                    conn[1].close()
+                return resp
+
+    def close(self):
+        "Close all idle connections"
+        for conns in self.idle.values():
+            for item in conns:
+                item[1].close()
+        self.idle = {}
+
+
+class AsyncSession:
+    """Long-lived login session of the asyncio engine
+
+Just like common.SharedSession, the token is refreshed REFRESH_MARGIN
+seconds before it expires, and requests to the WebAPI rejected with 401
+or 403 log in again and are retried once. Requests to the web server
+and the file server go through their own clients, web and file.
+"""
+
+    def __init__(self, web: AsyncHTTP, file: AsyncHTTP):
+        self.web = web
+        self.file = file
+        self.token = None
+        self.time = None
+        self.lock = asyncio.Lock()
+
+    async def login(self):
+        "Get website auth token for this session"
+        api = common.WebRequest
+        if api.username is None or api.password is None:
+            raise PermissionError("Login info not set")
+        resp = await self.web.request(
+            "POST",
+            os.path.join(api.webserver, "rest/session/init"),
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+                "Accept": "application/json"
+            },
+            body=up.urlencode({"name": api.username}).encode("ascii")
+        )
+        if resp.status != 200:
+            raise PermissionError("Server maintenance")
+        data = json.loads(resp.data.decode("utf-8"))
+        resp = await self.web.request(
+            "POST",
+            os.path.join(api.webserver, "rest/session/login"),
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded"
+            },
+            body=up.urlencode({
+                "id": data["id"],
+                "pass": api.hash_password(
+                    salt=data["hash"],
+                    session=data["id"]
+                )
+            }).encode("ascii")
+        )
+        if resp.status != 202:
+            raise PermissionError("Login failed")
+        self.token = data["id"]
+        self.time = time.time()
+        print(
+            "Login successful as", api.username,
+            file=sys.stderr, flush=True
+        )
+
+    async def logout(self):
+        "Revoke the current token"
+        if self.token is None:
+            # Not successfully initialized. Do nothing
+            return
+        resp = await self.web.request(
+            "DELETE",
+            os.path.join(common.WebRequest.webserver, "rest/session/login")
+            + "?"+up.urlencode({"id": self.token})
+        )
+        self.token = None
+        if resp.status == 202:
+            print("Logout sucessful.")
+            return
+        print("Logout failed, error code:", resp.status)
+
+    async def refresh(self, stale: str = None):
+        "Log in if the token is missing, about to expire or still stale"
+        async with self.lock:
+            if (
+                self.token is None
+                or (stale is not None and self.token == stale)
+                or self.time + common.WebRequest.SESSION_TIMEOUT
+                - common.SharedSession.REFRESH_MARGIN < time.time()
+            ):
+                await self.login()
+
+    async def request(
+        self, method: str, url: str, body=b"", headers=None
+    ) -> Response:
+        "Request to WebAPI, logging in again if the token is rejected"
+        for retry in (False, True):
+            await self.refresh()
+            token = self.token
+            resp = await self.web.request(
+                method, os.path.join(common.WebRequest.webserver, url),
+                body=body,
+                headers=dict(headers or {}, Cookie="SessionID="+token)
+            )
+            if retry or resp.status not in (401, 403):
+                return resp
+            print(
+                "Session rejected. Logging in again...",
+                file=sys.stderr, flush=True
+            )
+            await self.refresh(token)
+        return resp
+
+    async def request_file(
+        self, method: str, url: str, body=b"", headers=None
+    ) -> Response:
+        "Request to FileAPI, all parameters being added by the caller"
+        return await self.file.request(
+            method, os.path.join(common.WebRequest.fileserver, url),
+            body=body, headers=headers
+        )
+
+    async def request_form(self, url: str, query: dict) -> Response:
+        "Post a form to the FileAPI as common.WebRequest.request_form does"
+        for retry in (False, True):
+            await self.refresh()
+            token = self.token
+            resp = await self.request_file(
+                "POST", url,
+                headers={
+                    "Content-Type": "application/x-www-form-urlencoded",
+                    "Origin": common.WebRequest.webserver
+                },
+                body=up.urlencode({"session": token, **query}).encode("ascii")
+            )
+            if retry or resp.status not in (401, 403):
+                return resp
+            print(
+                "Session rejected. Logging in again...",
+                file=sys.stderr, flush=True
+            )
+            await self.refresh(token)
+        return resp
+
+
+class Engine:
+    """Runner of the upload queue on the event loop
+
+Tasks are taken from upload.QUEUE only when one of the [cloud] workers
+slots is free, so that the queue still decides which file goes next.
+Slots are given back while the upload server finalizes a file.
+"""
+
+    def __init__(self):
+        cloud = common.CONFIG["cloud"]
+        self.window = max(int(cloud["parallel_chunks"]), 1)
+        self.limit = int(cloud["workers"]) * self.window
+        web_size, file_size = common.pool_settings(common.CONFIG)[:2]
+        self.session = AsyncSession(
+            AsyncHTTP("web", web_size, int(cloud["attempt"])),
+            AsyncHTTP("file", file_size, int(cloud["attempt"]))
+        )
+        self.slots = asyncio.Semaphore(int(cloud["workers"]))
+        self.finalizing = set()
+        self.run_locks = {}
+        self.running = set()
+
+    async def run(self):
+        "Run the queued tasks till the termination sentinel"
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            task = await loop.run_in_executor(None, upload.QUEUE.get)
+            if task is None:
+                break
+            job = asyncio.ensure_future(self._dispatch(task))
+            self.running.add(job)
+            job.add_done_callback(self.running.discard)
+        if self.running:
+            await asyncio.wait(list(self.running))
+        await self.session.logout()
+        self.session.web.close()
+        self.session.file.close()
+
+    async def _dispatch(self, task):
+        "Run a single task, then free its slot"
+        try:
+            if isinstance(task, upload.UploadTask):
+                await self.upload_task(task)
+            elif isinstance(task, upload.CreateRunTask):
+                print("Initiate create_run from", task.src)
+                await self.ensure_run(task.conf)
+            else:
+                await self._offload(task.upload)
+        except Exception as err:  # pylint: disable=broad-except
+            print(
+                "Failed to process task for", task.src, ":", err,
+                file=sys.stderr, flush=True
+            )
+            if common.VERBOSE:
+                traceback.print_exc()
+        finally:
+            if task in self.finalizing:
+                # Slot given back already
+                self.finalizing.discard(task)
+            else:
+                self.slots.release()
+
+    @staticmethod
+    async def _offload(func, *args):
+        "Run a blocking call, file or journal access, off the event loop"
+        return await asyncio.get_running_loop().run_in_executor(
+            None, func, *args
+        )
+
+    async def ensure_run(self, conf: dict) -> tuple:
+        "Get the remote run mapping, creating the run on the server if needed"
+        if conf["id"] not in self.run_locks:
+            self.run_locks[conf["id"]] = asyncio.Lock()
+        async with self.run_locks[conf["id"]]:
+            mapping = await self._offload(common.DATABASE.get_run, conf["id"])
+            if mapping is not None:
+                return mapping
+            # Run ID should not exist on remote server. Create it.
+            print(
+                "New run found. Creating run...",
+                file=sys.stderr, flush=True
+            )
+            req = await self.session.request(**upload.run_form(conf))
+            mapping = (json.loads(req.data.decode("utf-8"))["id"], 0)
+            # Create a new run on uploadServer
+            upload.file_reply(await self.session.request_form(
+                "cgi-bin/createrun.py", upload.create_query(mapping)
+            ), "Run creation")
+            # Record the run_id mapping somewhere
+            await self._offload(
+                common.DATABASE.create_run, conf["id"], mapping[0]
+            )
+            return mapping
+
+    async def upload_task(self, task: upload.UploadTask):
+        "Upload a file of an UploadTask, holding its QUOTA reservation"
+        if not task.reserved:
+            if not upload.QUOTA.reserve(task.conf["id"]):
+                return
+            task.reserved = True
+        try:
+            result = await self._upload(task)
+        except BaseException:
+            task.release(False)
+            raise
+        if result is not None:
+            task.release(result)
+
+    async def _upload(self, task: upload.UploadTask) -> bool:
+        "Upload the file of a task as UploadTask._upload, None if requeued"
+        # Does the run exist on server?
+        mapping = await self._offload(common.DATABASE.get_run, task.conf["id"])
+        plan = await self._offload(task.prepare, mapping)
+        if plan is None:
+            return False
+        upload_token, encoding = plan
+        if upload_token is None:
+            mapping = await self.ensure_run(task.conf)
+            reply = await self._get_token(task, mapping, encoding)
+            if reply is None:
+                return False
+            upload_token, encoding = reply
+            await self._offload(task.start, upload_token, encoding)
+        if task.closed:
+            # Closed before a restart. Only the finalization is left.
+            try:
+                status = await self._finalize_status(upload_token)
+            except ConnectionError as err:
+                if not await self._offload(task.restart, err):
+                    raise
+                return await self._upload(task)
+            await self._submit(task, mapping, upload_token, status)
+            return True
+        try:
+            task.sha256 = await self.upload_file(
+                upload_token, task.src, encoding
+            )
+        except ConnectionError as err:
+            if not await self._offload(task.restart, err):
+                raise
+            return await self._upload(task)
+        except common.urllib3.exceptions.HTTPError as err:
+            if not task.retry(err):
+                raise
+            return None
+        status = await self._close(task, upload_token)
+        if await self._offload(task.mismatch, status):
+            return await self._upload(task)
+        await self._offload(task.mark_closed)
+        await self._submit(task, mapping, upload_token, status)
+        return True
+
+    async def _get_token(
+        self, task: upload.UploadTask, mapping: tuple, encoding: str
+    ) -> tuple:
+        "Obtain an upload token and the encoding accepted, as token_reply"
+        req = await self.session.request_form(
+            "cgi-bin/createrun.py", upload.token_query(mapping, encoding)
+        )
+        return upload.token_reply(req, task.src, encoding)
+
+    async def _put_block(
+        self, token: str, start: int, block, encoding: str
+    ) -> tuple:
+        "Send a single ranged block to the upload server, return its range"
+        rng = str(start)+"-"+str(start+len(block))
+        crc = zlib.crc32(block)
+        if encoding:
+            # Compress off the loop
+            data, encoding = await self._offload(
+                upload.Codec.encode, encoding, block
+            )
+        else:
+            data = block
+        fields = {"range": rng, "session": token, "crc32": format(crc, "08x")}
+        if encoding:
+            fields["encoding"] = encoding
+        fields["file"] = ("blob", data, "application/octet-stream")
+        body, headers = common.multipart_body(fields)
+        delay = common.WebRequest.limiter.reserve(len(data))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        began = time.monotonic()
+        try:
+            req = await self.session.request_file(
+                "PUT", "cgi-bin/upload.py", body=body, headers=headers
+            )
+        except Exception:
+            upload.SIZER.report(len(block))
+            raise
+        if req.status >= 400:
+            upload.SIZER.report(len(block))
+            raise ConnectionError(
+                "Block "+rng+" rejected with status "+str(req.status)
+            )
+        upload.SIZER.report(len(block), time.monotonic() - began)
+        print("=", end="", file=sys.stderr, flush=True)
+        return start, start+len(block)
+
+    async def _send_block(
+        self, token: str, start: int, view, buffer: bytearray, encoding: str
+    ) -> tuple:
+        "Send a block read into a pooled buffer, then release the buffer"
+        try:
+            return await self._put_block(token, start, view, encoding)
+        finally:
+            upload.BUFFERS.release(buffer, self.limit)
+
+    async def _ack(self, filepath: str, finished: set) -> Exception:
+        "Journal the acknowledged blocks, return the first failure if any"
+        failed = None
+        for item in finished:
+            if item.exception() is not None:
+                failed = failed or item.exception()
+                continue
+            await self._offload(
+                common.DATABASE.ack_chunk, filepath, *item.result()
+            )
+        return failed
+
+    async def upload_file(
+        self, token: str, filepath: str, encoding: str
+    ) -> str:
+        """Upload a file in ranged blocks, as upload.upload_file does
+
+Up to [cloud] parallel_chunks blocks are in flight at once, and each
+acknowledged block is journaled as it completes. A failed
+block is raised once the blocks still in flight are done and journaled.
+Blocks are read and hashed off the loop. Returns the SHA-256 of the file.
+"""
+        with open(filepath, "rb", buffering=0) as stdin:
+            size = os.fstat(stdin.fileno()).st_size
+            blocks = upload.plan_blocks(
+                await self._offload(upload.ranges_to_send, filepath, size)
+            )
+            block = next(blocks, None)
+            digest = hashlib.sha256()
+            hashed = 0
+            pending = set()
+            try:
+                while block is not None or pending:
+                    # Fill the window with the next blocks
+                    while block is not None and len(pending) < self.window:
+                        start, end = block
+                        buffer, view = await self._offload(
+                            upload.read_hashed, stdin, digest, hashed,
+                            start, end
+                        )
+                        hashed = end
+                        pending.add(asyncio.ensure_future(self._send_block(
+                            token, start, view, buffer, encoding
+                        )))
+                        block = next(blocks, None)
+                    finished, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    failed = await self._ack(filepath, finished)
+                    if failed is not None:
+                        # Journal the blocks still in flight before giving up
+                        if pending:
+                            finished = (await asyncio.wait(pending))[0]
+                            pending = set()
+                            await self._ack(filepath, finished)
+                        raise failed
+            finally:
+                for item in pending:
+                    item.cancel()
+                if pending:
+                    await asyncio.wait(pending)
+            await self._offload(upload.hash_range, stdin, digest, hashed, size)
+        print("", file=sys.stderr, flush=True)
+        return digest.hexdigest()
+
+    async def wait_finalized(self, token: str) -> str:
+        "Poll the finalization status of an upload till it is done"
+        started = time.time()
+        delay = upload.Finalizer.INITIAL_DELAY
+        status = "finalizing"
+        while status.lower() == "finalizing":
+            if time.time() - started > float(
+                common.CONFIG["cloud"]["finalize_timeout"]
+            ):
+                raise TimeoutError("Finalization of "+token+" timed out")
+            await asyncio.sleep(delay)
+            delay = upload.backoff(delay)
+            status = await self._finalize_status(token)
+        return status
+
+    async def _finalize_status(self, token: str) -> str:
+        "Ask the upload server for the finalization status of an upload"
+        req = await self.session.request_file(**upload.finalize_form(token))
+        return upload.file_reply(req, "Finalization of "+token)
+
+    async def _close(self, task: upload.UploadTask, upload_token: str) -> str:
+        "Close the uploaded file with its SHA-256, return the status"
+        req = await self.session.request_file(
+            **upload.close_form(upload_token, task.src, task.sha256)
+        )
+        return upload.file_reply(req, "Close of "+task.src)
+
+    async def _submit(
+        self, task: upload.UploadTask, mapping: tuple, upload_token: str,
+        status: str
+    ):
+        "Report the closed file once finalized"
+        if status.lower() == "finalizing":
+            # Let another file go on while the server finalizes. The
+            # report goes on without a slot, not to wait for the next file.
+            self.slots.release()
+            self.finalizing.add(task)
+            status = await self.wait_finalized(upload_token)
+        await self._report(task, mapping, upload_token, status)
+
+    async def _report(
+        self, task: upload.UploadTask, mapping: tuple, upload_token: str,
+        status: str
+    ):
+        "Report the finalized file and submit it for analysis"
+        # Report to webserver that the previous file has been uploaded.
+        await self.session.request(
+            **upload.report_form(mapping, upload_token, task.src, status)
+        )
+        # Submit all uploaded file to pipeline for analysis
+        upload.file_reply(await self.session.request_form(
+            "cgi-bin/submitfast5.py",
+            upload.submit_query(upload_token, mapping, task.conf)
+        ), "Submission")
+        # Upload successfully completed. Update the counter.
+        await self._offload(task.finish)
+
+
+async def _serve():
+    "Create the engine on the running loop and run it"
+    await Engine().run()
+
+
+def main():
+    "Run the upload queue on the asyncio engine till the termination sentinel"
+    asyncio.run(_serve())
@@ -28,6 +28,10 @@ def main():
         ),
         help="run tests only and quit"
     )
+    parser.add_argument(
+        "-s", "--status",
+        action="store_true", help="show the runs and uploads, and quit"
+    )
     parser.add_argument(
         "-v", "--version",
         action="version", version="%(prog)s "+common.__version__
@@ -38,6 +42,14 @@ def main():
     common.VERBOSE = args.debug
     common.CONFIG_SRC = args.config or common.CONFIG_SRC
     common.CONFIG = config.Config(common.CONFIG_SRC)
+    if args.status:
+        # Read only, not to block the running daemon
+        common.DATABASE = database.RunDB(readonly=True)
+        for item in common.DATABASE.get_runs():
+            print("Run", item[0], "as", item[1]+":", item[2], "files uploaded")
+        for item in common.DATABASE.get_uploads():
+            print("Uploading", item[0]+":", item[2], "of", item[1], "bytes")
+        return
     common.DATABASE = database.RunDB()
     # Run the daemon
     if args.test:
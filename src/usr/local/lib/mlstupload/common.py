@@ -5,7 +5,9 @@
 import hmac
 import json
 import os
+import socket
 import sys
+import threading
 import time
 import urllib.parse as up
 # Use pip vendored urllib3 as they would not upgrade till 2025
@@ -22,9 +24,130 @@ CONFIG_SRC = "/etc/mlstverse/fast5upload.conf"
 CONFIG = None
 DATABASE_SRC = "/var/lib/mlstverse/run.db"
 DATABASE = None
+SESSION = None
+METRICS = {}
+METRICS_LOCK = threading.Lock()
 
 
 # Class Definitions
+class TokenBucket:
+    """Token bucket bandwidth limiter shared by all upload workers
+
+The rate in bytes per second is [cloud] bandwidth, unless the current
+local time falls in a window of [cloud] bandwidth_schedule, written as
+comma separated HH:MM-HH:MM=rate entries. Rates take K, M or G suffixes
+and 0 means unlimited. Up to one second worth of unused bandwidth is
+saved up, so that bursts may use spare capacity.
+"""
+
+    def __init__(self):
+        self.rate = 0
+        self.schedule = []
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def configure(self, conf):
+        "Load the rate and schedule from conf"
+        self.rate = parse_size(conf["cloud"]["bandwidth"])
+        schedule = []
+        for item in conf["cloud"]["bandwidth_schedule"].split(","):
+            if not item.strip():
+                continue
+            window, rate = item.split("=")
+            start, end = (
+                int(entry.split(":")[0]) * 60 + int(entry.split(":")[1])
+                for entry in window.strip().split("-")
+            )
+            schedule.append((start, end, parse_size(rate)))
+        self.schedule = schedule
+
+    def current_rate(self) -> int:
+        "Get the rate for the current local time"
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if (
+                start <= minute < end
+                or (end < start and (minute >= start or minute < end))
+            ):
+                return rate
+        return self.rate
+
+    def reserve(self, size: int) -> float:
+        "Take size bytes from the bucket, return the seconds to wait first"
+        rate = self.current_rate()
+        if rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                float(rate), self.tokens + (now - self.stamp) * rate
+            )
+            self.stamp = now
+            # Borrow from the future. Later senders wait for the debt.
+            self.tokens -= size
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / rate
+
+    def consume(self, size: int):
+        "Wait till size bytes may be sent"
+        delay = self.reserve(size)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CountingPool:
+    """Mixin for connection pools counting reused and new connections
+
+Every connection taken from the pool is counted in METRICS[metric],
+as reused if it is still connected, otherwise as new. Without
+keep_alive, connections are closed as soon as they are put back.
+"""
+    metric = None
+    keep_alive = True
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)  # pylint: disable=no-member
+        count_connection(self.metric, getattr(conn, "sock", None) is not None)
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None and not self.keep_alive:
+            conn.close()
+        super()._put_conn(conn)  # pylint: disable=no-member
+
+
+class CountingHTTPConnectionPool(CountingPool, urllib3.HTTPConnectionPool):
+    "HTTP connection pool counting connections"
+
+
+class CountingHTTPSConnectionPool(CountingPool, urllib3.HTTPSConnectionPool):
+    "HTTPS connection pool counting connections"
+
+
+class CountingPoolManager(urllib3.PoolManager):
+    "PoolManager whose pools count their connections in METRICS[name]"
+
+    def __init__(
+        self, name: str, keep_alive: bool = True, **connection_pool_kw
+    ):
+        super().__init__(**connection_pool_kw)
+        self.name = name
+        self.keep_alive = keep_alive
+        self.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool
+        }
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.metric = self.name
+        pool.keep_alive = self.keep_alive
+        return pool
+
+
 class WebRequest:
     """Login Session Manager and API Request Creator for Web
 
@@ -36,6 +159,10 @@ Usage:
 
     To make a request, you may use the request() method,
     or the send_request() method.
+
+    Requests to the web server and the file server go through separate
+    connection pools, pool and filepool, tuned by [cloud] pool_size,
+    pool_block, connect_timeout, read_timeout and keep_alive.
 """
 
     __slots__ = ("token", "time")
@@ -45,8 +172,12 @@ Usage:
     password = None
     webserver = None
     fileserver = None
-    pool = urllib3.PoolManager(cert_reqs="CERT_REQUIRED")
+    pool = CountingPoolManager("web", cert_reqs="CERT_REQUIRED")
+    filepool = CountingPoolManager("file", cert_reqs="CERT_REQUIRED")
+    pool_conf = None
+    keep_alive = True
     retry = urllib3.Retry(3, allowed_methods=None)
+    limiter = TokenBucket()
 
     @classmethod
     def config_api(cls, conf):
@@ -56,6 +187,30 @@ Usage:
         cls.webserver = conf["cloud"]["website_server"]
         cls.fileserver = conf["cloud"]["upload_server"]
         cls.retry = urllib3.Retry(int(conf["cloud"]["attempt"]))
+        cls.limiter.configure(conf)
+        cls.keep_alive = conf["cloud"].getboolean("keep_alive")
+        pool_conf = pool_settings(conf)
+        if pool_conf != cls.pool_conf:
+            # Keep one connection per concurrent request instead of discarding
+            web_size, file_size, block, connect, read = pool_conf
+            options = urllib3.connection.HTTPConnection.default_socket_options
+            if cls.keep_alive:
+                # Probe idle connections so that they are not dropped
+                options = options + [
+                    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                ]
+            kw = {
+                "keep_alive": cls.keep_alive,
+                "cert_reqs": "CERT_REQUIRED",
+                "block": block,
+                "timeout": urllib3.Timeout(connect=connect, read=read),
+                "socket_options": options
+            }
+            cls.pool = CountingPoolManager("web", maxsize=web_size, **kw)
+            cls.filepool = CountingPoolManager(
+                "file", maxsize=file_size, **kw
+            )
+            cls.pool_conf = pool_conf
 
     @classmethod
     def hash_password(cls, salt: str, session: str) -> str:
@@ -76,19 +231,21 @@ Usage:
     def send_request(
         cls,
         method: str, url: str, body=None, fields=None, headers=None,
-        **urlopen_kw
+        pool=None, **urlopen_kw
     ) -> urllib3.response.HTTPResponse:
-        "Request wrapper for urllib3 to API for class"
+        "Request wrapper for urllib3 to API for class, on the web pool"
         if headers is None:
             headers = {}
         if "User-Agent" not in headers:
             headers["User-Agent"] = cls.USER_AGENT
+        if not cls.keep_alive:
+            headers["Connection"] = "close"
         if "retries" not in urlopen_kw:
             urlopen_kw["retries"] = cls.retry
         urlopen_kw["body"] = body
         urlopen_kw["fields"] = fields
         urlopen_kw["headers"] = headers
-        return cls.pool.request(
+        return (cls.pool if pool is None else pool).request(
             method, url,
             **{item[0]: item[1] for item in urlopen_kw.items() if item[1] is not None}
         )
@@ -103,7 +260,8 @@ As a higher level API, the url should be the API endpoint
 However, all parameters must be manually added to the request.
 """
         return cls.send_request(
-            method, os.path.join(cls.fileserver, url), **urlopen_kw
+            method, os.path.join(cls.fileserver, url), pool=cls.filepool,
+            **urlopen_kw
         )
 
     def __init__(self):
@@ -155,17 +313,47 @@ However, all parameters must be manually added to the request.
         if self.token is None:
             # Not successfully initialized. Do nothing
             return
-        resp = WebRequest.pool.request_encode_url(
+        resp = WebRequest.send_request(
             "DELETE",
             os.path.join(WebRequest.webserver, "rest/session/login"),
-            fields={"id": self.token},
-            headers={"User-Agent": WebRequest.USER_AGENT}
+            fields={"id": self.token}
         )
         if resp.status == 202:
             print("Logout sucessful.")
             return
         print("Logout failed, error code:", resp.status)
 
+    def refresh(self, stale: str = None):  # pylint: disable=unused-argument
+        "Log in again, the token stale being rejected"
+        self.login()
+
+    def request_form(
+        self, url: str, query: dict
+    ) -> urllib3.response.HTTPResponse:
+        """Post a form to the FileAPI on behalf of the login session
+
+The session token is added to the query. If the token is rejected with
+401 or 403, it is refreshed and the form is posted once more.
+"""
+        for retry in (False, True):
+            token = self.token
+            resp = WebRequest.request_file(
+                "POST", url,
+                headers={
+                    "Content-Type": "application/x-www-form-urlencoded",
+                    "Origin": WebRequest.webserver
+                },
+                body=up.urlencode({"session": token, **query}).encode("ascii")
+            )
+            if retry or resp.status not in (401, 403):
+                return resp
+            print(
+                "Session rejected. Logging in again...",
+                file=sys.stderr, flush=True
+            )
+            self.refresh(token)
+        return resp
+
     def request(
         self,
         method: str, url: str, body=None, fields=None, headers=None,
@@ -204,3 +392,172 @@ added to the request.
             # Not successfully initialized. Do nothing
             return
         self.logout()
+
+
+class SharedSession(WebRequest):
+    """Long-lived login session shared by all upload tasks
+
+Usage:
+    This class is used as a context manager just like WebRequest, but
+    it only logs in on first use and does not log out on exit, so that
+    every task reuses the same token. Call close() to revoke it.
+
+    The token is refreshed REFRESH_MARGIN seconds before it expires, and
+    requests to the WebAPI rejected with 401 or 403 log in again and are
+    retried once.
+"""
+
+    __slots__ = ("lock",)
+    REFRESH_MARGIN = 300
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def refresh(self, stale: str = None):
+        """Log in if the token is missing or about to expire
+
+If stale is given, log in again unless another thread already replaced
+that token.
+"""
+        with self.lock:
+            if (
+                self.token is None
+                or (stale is not None and self.token == stale)
+                or self.time + WebRequest.SESSION_TIMEOUT
+                - SharedSession.REFRESH_MARGIN < time.time()
+            ):
+                self.login()
+
+    def close(self):
+        "Revoke the shared token"
+        with self.lock:
+            self.logout()
+            self.token = None
+
+    def request(
+        self,
+        method: str, url: str, body=None, fields=None, headers=None,
+        **urlopen_kw
+    ) -> urllib3.response.HTTPResponse:
+        "Request wrapper to WebAPI, logging in again if the token is rejected"
+        self.refresh()
+        token = self.token
+        resp = super().request(
+            method, url, body=body, fields=fields, headers=headers,
+            **urlopen_kw
+        )
+        if resp.status in (401, 403):
+            print(
+                "Session rejected. Logging in again...",
+                file=sys.stderr, flush=True
+            )
+            self.refresh(token)
+            resp = super().request(
+                method, url, body=body, fields=fields, headers=headers,
+                **urlopen_kw
+            )
+        return resp
+
+    def __enter__(self):
+        self.refresh()
+        return self
+
+    def __exit__(self, *_):
+        # Keep the session for the next task
+        return
+
+
+def count_connection(name: str, reused: bool):
+    "Count a reused or new connection of a pool in METRICS[name]"
+    with METRICS_LOCK:
+        counts = METRICS.setdefault(name, {"reused": 0, "new": 0})
+        counts["reused" if reused else "new"] += 1
+
+
+def format_metrics() -> str:
+    "Describe the connections counted and the block size learnt in METRICS"
+    with METRICS_LOCK:
+        items = [
+            name+" "+str(counts["reused"])+" reused, "
+            + str(counts["new"])+" new"
+            for name, counts in sorted(METRICS.items())
+            if isinstance(counts, dict)
+        ]
+        block_size = METRICS.get("block_size")
+    text = "Connections: "+("; ".join(items) or "none")+"."
+    if block_size is not None:
+        text += " Adaptive block size: "+str(block_size)+" bytes."
+    return text
+
+
+def pool_settings(conf) -> tuple:
+    """Get the connection pool settings from conf
+
+Returns (web pool size, file pool size, block, connect timeout, read
+timeout). Unless [cloud] pool_size is set, the web pool has a connection
+per worker and the file pool one per block in flight.
+"""
+    workers = int(conf["cloud"]["workers"])
+    if conf["cloud"]["pool_size"]:
+        web_size = file_size = int(conf["cloud"]["pool_size"])
+    else:
+        web_size = workers
+        file_size = workers * max(int(conf["cloud"]["parallel_chunks"]), 1)
+    return (
+        web_size, file_size,
+        conf["cloud"].getboolean("pool_block"),
+        float(conf["cloud"]["connect_timeout"]),
+        float(conf["cloud"]["read_timeout"])
+    )
+
+
+def parse_size(text: str) -> int:
+    "Parse a byte count with an optional K, M or G suffix"
+    text = text.strip().upper()
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text or "0"))
+
+
+def multipart_body(fields: dict) -> tuple:
+    """Encode fields as a multipart/form-data body without copying data
+
+The fields take the same form as the fields of urllib3. File data may be
+any bytes-like object such as a memoryview of a reusable buffer. Returns
+the body as a tuple of parts to be sent in turn, with its headers.
+"""
+    boundary = urllib3.filepost.choose_boundary()
+    parts = []
+    length = 0
+    for name, value in fields.items():
+        if isinstance(value, tuple):
+            head = (
+                "--"+boundary+"\r\n"
+                'Content-Disposition: form-data; name="'+name+'"; '
+                'filename="'+value[0]+'"\r\n'
+                "Content-Type: "+value[2]+"\r\n\r\n"
+            ).encode("utf-8")
+            data = value[1]
+        else:
+            head = (
+                "--"+boundary+"\r\n"
+                'Content-Disposition: form-data; name="'+name+'"\r\n\r\n'
+            ).encode("utf-8")
+            data = str(value).encode("utf-8")
+        parts.extend((head, data, b"\r\n"))
+        length += len(head) + memoryview(data).nbytes + 2
+    parts.append(("--"+boundary+"--\r\n").encode("ascii"))
+    length += len(parts[-1])
+    return tuple(parts), {
+        "Content-Type": "multipart/form-data; boundary="+boundary,
+        "Content-Length": str(length)
+    }
+
+
+def session() -> WebRequest:
+    "Get the shared login session if available, otherwise a new one"
+    if SESSION is not None:
+        return SESSION
+    return WebRequest()
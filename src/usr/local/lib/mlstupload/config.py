@@ -11,11 +11,41 @@ from . import common
 TEMPLATE_CONF = {
     "local": {
         "runid_db": "/var/lib/mlstverse/run.db",
+        "db_flush": "1",
         "data": "/var/lib/minknow/data",
-        "max_data": ""
+        "max_data": "",
+        "backfill_hours": "0",
+        "dedup_cache": "100000",
+        "minknow_ttl": "86400",
+        "minknow_miss_ttl": "60",
+        "minknow_watch": "yes",
+        "queue_policy": "fifo",
+        "settle_time": "5",
+        "settle_timeout": "600",
+        "batch_delay": "0.5",
+        "watch": "all",
+        "monitor": "inotify",
+        "poll_interval": "10"
     },
     "cloud": {
         "attempt": "3",
+        "engine": "thread",
+        "workers": "1",
+        "parallel_chunks": "1",
+        "block_size": "2097152",
+        "adaptive_block": "no",
+        "block_size_min": "262144",
+        "block_size_max": "16777216",
+        "bandwidth": "0",
+        "bandwidth_schedule": "",
+        "finalize_timeout": "3600",
+        "compress": "no",
+        "compress_ratio": "0.9",
+        "pool_size": "",
+        "pool_block": "no",
+        "connect_timeout": "30",
+        "read_timeout": "300",
+        "keep_alive": "yes",
         "website_server": "https://mlstverse.org",
         "upload_server":
             "https://www.gen-info.osaka-u.ac.jp/realtime-mlstverse"
@@ -2,23 +2,314 @@
 
 "Watchdog daemon that monitors the creation of new data files"
 
+import collections
+import errno
 import os
 import signal
 import socket
 import sys
+import threading
+import time
 
 # Import third-party
 import watchdog.observers
 import watchdog.events
 
+from . import aioupload
 from . import common
 from . import staphminknow
 from . import upload
 
 
+DATA_EXT = (".fast5", ".pod5")
+POD5_SIGNATURE = b"\x8bPOD\r\n\x1a\n"
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+
+class DedupIndex:
+    """Index of data files already queued or uploaded
+
+Queued paths are kept in an in-memory LRU cache of at most
+[local] dedup_cache entries. Paths missing from the cache are looked up
+by path, size and mtime in the uploaded file record of RunDB, so that
+duplicates are still rejected after eviction or a restart.
+"""
+
+    def __init__(self):
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, path: str) -> bool:
+        with self.lock:
+            if path in self.cache:
+                self.cache.move_to_end(path)
+                return True
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return common.DATABASE.is_uploaded(
+            path, stat.st_size, stat.st_mtime_ns
+        )
+
+    def add(self, path: str):
+        "Record a queued path, evicting the least recently seen ones"
+        limit = int(common.CONFIG["local"]["dedup_cache"])
+        with self.lock:
+            self.cache[path] = None
+            self.cache.move_to_end(path)
+            while len(self.cache) > limit:
+                self.cache.popitem(last=False)
+
+    def discard(self, path: str):
+        "Forget a queued path, to queue it again when found"
+        with self.lock:
+            self.cache.pop(path, None)
+
+
+def _hdf5_end(head: bytes) -> int:
+    "Get the end of file address from an HDF5 superblock, None if unset"
+    version = head[8]
+    if version < 2:
+        # Base, free space, end of file addresses after the fixed fields
+        width = head[13]
+        offset = 24 if version == 0 else 28
+        base = int.from_bytes(head[offset:offset+width], "little")
+        offset += width * 2
+    else:
+        if version >= 3 and head[11] & 0x05:
+            # Still open for writing
+            return None
+        width = head[9]
+        base = int.from_bytes(head[12:12+width], "little")
+        offset = 12 + width * 2
+    end = head[offset:offset+width]
+    if len(end) < width or end == b"\xff" * width:
+        return None
+    return base + int.from_bytes(end, "little")
+
+
+def footer_valid(path: str) -> bool:
+    """Check if the format of a data file shows a complete write
+
+A pod5 file ends with the signature it starts with only once it is
+closed. An HDF5 fast5 file must be as long as the end of file address
+recorded in its superblock.
+"""
+    try:
+        with open(path, "rb") as stdin:
+            size = os.fstat(stdin.fileno()).st_size
+            head = stdin.read(64)
+            if path.endswith(".pod5"):
+                stdin.seek(max(size - len(POD5_SIGNATURE), len(head)))
+                return (
+                    head.startswith(POD5_SIGNATURE)
+                    and size >= len(POD5_SIGNATURE) * 2
+                    and stdin.read() == POD5_SIGNATURE
+                )
+            if not head.startswith(HDF5_SIGNATURE) or len(head) < 64:
+                return False
+            end = _hdf5_end(head)
+            return end is not None and end <= size
+    except OSError:
+        return False
+
+
+class Settler:
+    """Settle stage holding data files till they are completely written
+
+Files are tracked from the time they are found. A pod5 file is released
+to callback as soon as its footer is valid. A fast5 file needs a valid
+superblock as well, and to be closed after writing or left unchanged for
+[local] settle_time seconds. Held files are checked again every INTERVAL
+seconds, or at once when closed, and files left unchanged but never
+valid for [local] settle_timeout seconds are released anyway.
+"""
+    INTERVAL = 1.0
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.files = {}
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def track(self, path: str, closed: bool = False, run_info: dict = None):
+        "Hold a file till it is complete, to be released with its run info"
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        # Files found long after their last write are settled already
+        changed = time.monotonic() - max(time.time() - stat.st_mtime, 0)
+        with self.cond:
+            if path in self.files and not closed:
+                return
+            self.files[path] = [
+                stat.st_size, stat.st_mtime_ns, changed, closed, run_info
+            ]
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._loop, name="settle", daemon=True
+                )
+                self.thread.start()
+            self.cond.notify()
+
+    def modified(self, path: str):
+        "Note a write to a held file"
+        with self.cond:
+            if path in self.files:
+                self.files[path][3] = False
+
+    def _loop(self):
+        "Check the held files till they are released"
+        while True:
+            with self.cond:
+                self.cond.wait(Settler.INTERVAL)
+                paths = list(self.files)
+            for path in paths:
+                run_info = self._settled(path)
+                if run_info is not False:
+                    try:
+                        self.callback(path, run_info)
+                    except Exception as err:  # pylint: disable=broad-except
+                        print(
+                            "Failed to handle", path, ":", err,
+                            file=sys.stderr, flush=True
+                        )
+
+    def _settled(self, path: str):
+        """Check a held file, and stop holding it if it is complete
+
+Returns the run info of a released file, or False if it is still held.
+"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Removed or moved away
+            with self.cond:
+                self.files.pop(path, None)
+            return False
+        valid = footer_valid(path)
+        now = time.monotonic()
+        with self.cond:
+            entry = self.files.get(path)
+            if entry is None:
+                return False
+            if entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+                entry[:4] = [stat.st_size, stat.st_mtime_ns, now, False]
+            idle = now - entry[2]
+            if valid and (
+                path.endswith(".pod5") or entry[3]
+                or idle >= float(common.CONFIG["local"]["settle_time"])
+            ):
+                return self.files.pop(path)[4]
+            if idle >= float(common.CONFIG["local"]["settle_timeout"]):
+                print(
+                    "File", path, "never completed. Uploading as is.",
+                    file=sys.stderr, flush=True
+                )
+                return self.files.pop(path)[4]
+        return False
+
+
+class EventIntake:
+    """Buffer of file system events, handled in batches off the observer
+
+The observer thread only records events here. They are passed on to
+callback from another thread once no event came for [local] batch_delay
+seconds, or at the latest MAX_WAIT seconds after the first one, so that
+a burst of events never stalls the observer. Events of the same path in
+a batch are coalesced: callback gets the new directories, and for each
+file whether it is new and whether it was last closed (True) or written
+(False) to, None if neither. After each batch, overflow gets the number
+of watch events it coalesced, the directories they touched and the time
+the first one came. Only the paths added with event set are counted, not
+those found by scans.
+"""
+    MAX_WAIT = 5.0
+
+    def __init__(self, callback, overflow=None):
+        self.callback = callback
+        self.overflow = overflow
+        self.dirs = {}
+        self.files = {}
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.since = None
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def add_dir(self, path: str, event: bool = False):
+        "Record a new directory"
+        with self.cond:
+            self.dirs[path] = None
+            self._added(event)
+
+    def add(
+        self, path: str, new: bool = False, closed: bool = None,
+        event: bool = False
+    ):
+        "Record a file found, closed after writing or written to"
+        with self.cond:
+            entry = self.files.setdefault(path, [False, None])
+            entry[0] = entry[0] or new
+            if closed is not None:
+                entry[1] = closed
+            self._added(event)
+
+    def _added(self, event: bool):
+        "Note the time of an event and wake the batcher, with cond held"
+        if event:
+            self.count += 1
+        self.last = time.monotonic()
+        if self.first is None:
+            self.first = self.last
+            self.since = time.time()
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._loop, name="intake", daemon=True
+            )
+            self.thread.start()
+        self.cond.notify()
+
+    def _loop(self):
+        "Pass the recorded events on in batches"
+        while True:
+            with self.cond:
+                while self.first is None:
+                    self.cond.wait()
+                delay = float(common.CONFIG["local"]["batch_delay"])
+                while True:
+                    now = time.monotonic()
+                    wait = min(
+                        self.last + delay,
+                        self.first + EventIntake.MAX_WAIT
+                    ) - now
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                dirs, files = list(self.dirs), self.files
+                count, since = self.count, self.since
+                self.dirs, self.files = {}, {}
+                self.count = 0
+                self.first = self.last = self.since = None
+            try:
+                self.callback(dirs, files)
+                if self.overflow is not None:
+                    folders = set(dirs)
+                    folders.update(os.path.dirname(path) for path in files)
+                    self.overflow(count, folders, since)
+            except Exception as err:  # pylint: disable=broad-except
+                print(
+                    "Failed to handle events:", err,
+                    file=sys.stderr, flush=True
+                )
+
+
 class FileModifyHandler(watchdog.events.FileSystemEventHandler):
     "Watchdog Override to trigger upload_fast5 when a fast5/pod5 is found"
-    dedup = set()
+    dedup = DedupIndex()
 
     @staticmethod
     def _handle_run_directory(path: str):
@@ -40,10 +331,10 @@ class FileModifyHandler(watchdog.events.FileSystemEventHandler):
             # upload.create_run(run_info)
 
     @staticmethod
-    def _handle_signal_file(path: str):
+    def _handle_signal_file(path: str, run_info: dict = None):
         "Handle signal file for uploading etc"
         ext = os.path.splitext(path)[1]
-        if ext in (".fast5", ".pod5"):
+        if ext in DATA_EXT:
             if (
                 path in FileModifyHandler.dedup and
                 not path.startswith("reup")
@@ -74,16 +365,19 @@ class FileModifyHandler(watchdog.events.FileSystemEventHandler):
                 FileModifyHandler.dedup.add(path)
             try:
                 # Attempt to queue a file for uploading
-                # Get the run info at the same time as we found the file
-                run_info = staphminknow.MinKnow.get_run_info(path)
-                if run_info is not None:
+                # Get the run info unless resolved when the file was found
+                if run_info is None:
+                    run_info = staphminknow.MinKnow.get_run_info(path)
+                if run_info is not None and upload.QUOTA.reserve(
+                    run_info["id"]
+                ):
                     # We have a valid data file to upload. Queue it.
                     print(
                         "C: Queued", path,
                         file=sys.stderr, flush=True
                     )
                     upload.QUEUE.put(
-                        upload.UploadTask(path, run_info)
+                        upload.UploadTask(path, run_info, reserved=True)
                     )
             except Exception as err:  # pylint: disable=broad-except
                 print(
@@ -95,16 +389,62 @@ class FileModifyHandler(watchdog.events.FileSystemEventHandler):
             if common.VERBOSE:
                 print("Skipping", path, file=sys.stderr, flush=True)
 
+    @staticmethod
+    def _handle_batch(dirs: list, files: dict):
+        """Handle a batch of coalesced events from the intake
+
+Run info is resolved once per directory. Data files of the runs are then
+held till they are complete, and other files are handled at once.
+"""
+        for path in dirs:
+            FileModifyHandler._handle_run_directory(path)
+        Monitor.check_dirs(dirs)
+        run_infos = {}
+        for path, (new, closed) in files.items():
+            if not new and not closed:
+                if closed is not None:
+                    FileModifyHandler.settler.modified(path)
+                continue
+            if (
+                os.path.splitext(path)[1] not in DATA_EXT
+                or os.path.basename(path) == "DAEMON_WATCH_TEST.pod5"
+            ):
+                FileModifyHandler._handle_signal_file(path)
+                continue
+            folder = os.path.dirname(path)
+            if folder not in run_infos:
+                try:
+                    run_infos[folder] = staphminknow.MinKnow.get_run_info(
+                        path
+                    )
+                except Exception as err:  # pylint: disable=broad-except
+                    print(
+                        "Failed to get run info of", folder, ":", err,
+                        file=sys.stderr, flush=True
+                    )
+                    # Looked up again once the file is complete
+                    run_infos[folder] = False
+            if run_infos[folder] is None:
+                # Not in a sequencing run
+                if common.VERBOSE:
+                    print("Skipping", path, file=sys.stderr, flush=True)
+                continue
+            FileModifyHandler.settler.track(
+                path, bool(closed), run_infos[folder] or None
+            )
+
     def on_created(self, event: watchdog.events.FileSystemEvent):
         "Handle FileCreate event from move directory"
         if isinstance(event, watchdog.events.DirCreatedEvent):
             if common.VERBOSE:
                 print("+", event.src_path, file=sys.stderr, flush=True)
-            FileModifyHandler._handle_run_directory(event.src_path)
+            FileModifyHandler.intake.add_dir(event.src_path, event=True)
         if isinstance(event, watchdog.events.FileCreatedEvent):
             if common.VERBOSE:
                 print("+", event.src_path, file=sys.stderr, flush=True)
-            FileModifyHandler._handle_signal_file(event.src_path)
+            FileModifyHandler.intake.add(
+                event.src_path, new=True, event=True
+            )
 
     def on_moved(self, event: watchdog.events.FileSystemEvent):
         "Handle FileMove event from rename"
@@ -114,30 +454,479 @@ class FileModifyHandler(watchdog.events.FileSystemEventHandler):
                     event.src_path, "->", event.dest_path,
                     file=sys.stderr, flush=True
                 )
-            FileModifyHandler._handle_run_directory(event.dest_path)
+            FileModifyHandler.intake.add_dir(event.dest_path, event=True)
         if isinstance(event, watchdog.events.FileMovedEvent):
             if common.VERBOSE:
                 print(
                     event.src_path, "->", event.dest_path,
                     file=sys.stderr, flush=True
                 )
-            FileModifyHandler._handle_signal_file(event.dest_path)
+            FileModifyHandler.intake.add(
+                event.dest_path, new=True, event=True
+            )
+
+    def on_modified(self, event: watchdog.events.FileSystemEvent):
+        "Handle FileModify event of a file being written"
+        if isinstance(event, watchdog.events.FileModifiedEvent) and (
+            os.path.splitext(event.src_path)[1] in DATA_EXT
+        ):
+            FileModifyHandler.intake.add(
+                event.src_path, closed=False, event=True
+            )
+
+    def on_closed(self, event: watchdog.events.FileSystemEvent):
+        "Handle FileClosed event of a file closed after writing"
+        if os.path.splitext(event.src_path)[1] in DATA_EXT:
+            FileModifyHandler.intake.add(
+                event.src_path, closed=True, event=True
+            )
+
+
+class PollScanner(threading.Thread):
+    """Scanner polling a directory tree, where inotify does not fire
+
+For network file systems like NFS and CIFS. Each pass checks the mtime
+of every indexed directory, and only lists again those that changed;
+the subdirectories of the others come from the index. New directories
+and data files go to the intake as if found by the watches, except on
+the first pass that only builds the index, unless existing is set.
+Directories changed within SLACK seconds of their last listing are
+listed again on the next pass, as a coarse mtime may hide a change.
+As a thread, it scans every [local] poll_interval seconds till stopped.
+"""
+    SLACK = 2.0
+
+    def __init__(self, root: str, existing: bool = False):
+        super().__init__(name="poll", daemon=True)
+        self.root = root
+        self.existing = existing
+        self.index = {}
+        self.stopped = threading.Event()
+
+    def _drop(self, path: str):
+        "Remove a directory and its subdirectories from the index"
+        stack = [path]
+        while stack:
+            entry = self.index.pop(stack.pop(), None)
+            if entry is not None:
+                stack.extend(entry[2])
+
+    def scan(self):
+        "Check the tree once, passing on what appeared since the last pass"
+        first = not self.index
+        slack = int(PollScanner.SLACK * 1e9)
+        stack = [self.root]
+        while stack:
+            path = stack.pop()
+            entry = self.index.get(path)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                self._drop(path)  # Removed
+                continue
+            if entry is not None and entry[0] == mtime < entry[1] - slack:
+                stack.extend(entry[2])
+                continue
+            listed = time.time_ns()
+            subdirs, files = [], set()
+            try:
+                with os.scandir(path) as entries:
+                    for item in entries:
+                        if item.is_dir(follow_symlinks=False):
+                            subdirs.append(item.path)
+                        elif os.path.splitext(item.name)[1] in DATA_EXT:
+                            files.add(item.name)
+            except OSError as err:
+                print("Cannot scan", err, file=sys.stderr, flush=True)
+                self._drop(path)
+                continue
+            if entry is None:
+                if not first:
+                    FileModifyHandler.intake.add_dir(path)
+                known = set()
+            else:
+                for item in set(entry[2]).difference(subdirs):
+                    self._drop(item)
+                known = entry[3]
+            if not first or self.existing:
+                for name in files.difference(known):
+                    FileModifyHandler.intake.add(
+                        os.path.join(path, name), new=True
+                    )
+            self.index[path] = [mtime, listed, subdirs, files]
+            stack.extend(subdirs)
+
+    def run(self):
+        "Scan the tree till stopped"
+        while not self.stopped.is_set():
+            try:
+                self.scan()
+            except Exception as err:  # pylint: disable=broad-except
+                print(
+                    "Failed to scan", self.root, ":", err,
+                    file=sys.stderr, flush=True
+                )
+            self.stopped.wait(float(common.CONFIG["local"]["poll_interval"]))
+
+    def stop(self):
+        "Stop scanning after the current pass"
+        self.stopped.set()
+
+
+class Monitor:
+    """Watches of the data directory, kept complete within inotify limits
+
+With [local] watch = all, the data directory is watched recursively. If
+the inotify watch or instance limit does not allow that, the monitor
+falls back to watching only the output directories of the runs cached in
+MinKnow.data, as watch = active does from the start. Directories that
+cannot be watched at the limits are polled by a PollScanner every
+INTERVAL seconds instead, and those of watches found dead or gone are
+rescanned once watched again.
+
+Watchdog drops the notice of an inotify queue overflow, so a batch of
+events reaching OVERFLOW_RATIO of fs.inotify.max_queued_events is taken
+as one, and the directories it touched are rescanned for the files
+modified since it began.
+
+With [local] monitor = poll and watch = active, nothing is watched and
+the output directories of the cached runs are polled every [local]
+poll_interval seconds instead of the whole data directory.
+"""
+    INTERVAL = 10.0
+    OVERFLOW_RATIO = 0.5
+    handler = FileModifyHandler()
+    watches = {}
+    polled = {}
+    rescans = {}
+    active = False
+    polling = False
+    running = False
+    warned = False
+    cond = threading.Condition()
+
+    @staticmethod
+    def _inotify_limit(name: str) -> int:
+        "Get an inotify limit of the kernel, 0 if unknown"
+        try:
+            with open(
+                "/proc/sys/fs/inotify/"+name, "r", encoding="ascii"
+            ) as stdin:
+                return int(stdin.read())
+        except (OSError, ValueError):
+            return 0
+
+    @staticmethod
+    def _watch_count() -> int:
+        "Count the inotify watches held by this process"
+        count = 0
+        try:
+            fds = os.listdir("/proc/self/fdinfo")
+        except OSError:
+            return 0
+        for item in fds:
+            try:
+                with open(
+                    "/proc/self/fdinfo/"+item, "r", encoding="ascii"
+                ) as stdin:
+                    count += sum(
+                        1 for line in stdin if line.startswith("inotify wd:")
+                    )
+            except OSError:
+                continue
+        return count
+
+    @classmethod
+    def _schedule(cls, path: str) -> bool:
+        """Watch a directory recursively, with cond held
+
+Returns False at the inotify limits. Failed watches are not retried, as
+watchdog leaks the inotify instance of each.
+"""
+        try:
+            cls.watches[path] = upload.OBSERVER.schedule(
+                cls.handler, path, recursive=True
+            )
+        except OSError as err:
+            if err.errno not in (errno.ENOSPC, errno.EMFILE):
+                raise
+            print(
+                "Cannot watch", path, ":", err.strerror+".",
+                "Raise fs.inotify.max_user_watches and max_user_instances.",
+                file=sys.stderr, flush=True
+            )
+            return False
+        return True
+
+    @classmethod
+    def _unschedule(cls, path: str):
+        "Stop watching or polling a directory, with cond held"
+        cls.polled.pop(path, None)
+        watch = cls.watches.pop(path, None)
+        if watch is not None:
+            try:
+                upload.OBSERVER.unschedule(watch)
+            except KeyError:
+                pass  # Never started
+
+    @classmethod
+    def start(cls):
+        "Start the observer with the watches of the configured mode"
+        cls.polling = common.CONFIG["local"]["monitor"] == "poll"
+        if not cls.polling:
+            observer = watchdog.observers.Observer()
+            observer.start()
+            upload.OBSERVER = observer
+        cls.active = common.CONFIG["local"]["watch"] == "active"
+        cls.running = True
+        with cls.cond:
+            if not cls.active and not cls._schedule(
+                common.CONFIG["local"]["data"]
+            ):
+                print(
+                    "Watching the directories of active runs only.",
+                    file=sys.stderr, flush=True
+                )
+                cls.active = True
+        staphminknow.MinKnow.run_hook.add(cls.run_started)
+        threading.Thread(
+            target=cls._loop, name="monitor", daemon=True
+        ).start()
+
+    @classmethod
+    def run_started(cls, _path: str, _run_info: dict):
+        "Watch the directory of a new run without waiting for the next check"
+        with cls.cond:
+            cls.cond.notify()
+
+    @classmethod
+    def check_dirs(cls, dirs: list):
+        "Poll the new directories if they were left unwatched at the limit"
+        if not dirs or cls.polling:
+            return
+        limit = cls._inotify_limit("max_user_watches")
+        if not limit or cls._watch_count() < limit:
+            return
+        with cls.cond:
+            for path in dirs:
+                if path not in cls.polled:
+                    cls.polled[path] = PollScanner(path, True)
+            if not cls.warned:
+                cls.warned = True
+                print(
+                    "Inotify watch limit reached. Polling new directories.",
+                    "Raise fs.inotify.max_user_watches.",
+                    file=sys.stderr, flush=True
+                )
+
+    @classmethod
+    def overflow(cls, count: int, folders: set, since: float):
+        "Rescan the directories of a burst of events that may have overflowed"
+        limit = cls._inotify_limit("max_queued_events")
+        if not cls.running or not limit or (
+            count < limit * Monitor.OVERFLOW_RATIO
+        ):
+            return
+        print(
+            "Burst of", count, "events may have overflowed the inotify queue.",
+            "Rescanning", len(folders), "directories.",
+            file=sys.stderr, flush=True
+        )
+        with cls.cond:
+            for path in folders:
+                cls.rescans[path] = min(cls.rescans.get(path, since), since)
+            cls.cond.notify()
+
+    @classmethod
+    def _sync_runs(cls, rescans: dict):
+        "Watch the directories of the cached runs only"
+        minknow = staphminknow.MinKnow
+        if not common.CONFIG["local"].getboolean("minknow_watch") and (
+            time.time() - minknow.updated
+            >= float(common.CONFIG["local"]["minknow_miss_ttl"])
+        ):
+            with minknow.lock:
+                try:
+                    minknow.refresh()
+                except Exception as err:  # pylint: disable=broad-except
+                    print(
+                        "Updating sequencer position info failed.", err,
+                        file=sys.stderr, flush=True
+                    )
+                    minknow.failed = time.time()
+        root = os.path.join(common.CONFIG["local"]["data"], "")
+        runs = {
+            path for path in minknow.data
+            if path.startswith(root) and os.path.isdir(path)
+        }
+        with cls.cond:
+            for path in set(cls.watches).union(cls.polled):
+                if not any(
+                    path == item or path.startswith(os.path.join(item, ""))
+                    for item in runs
+                ):
+                    cls._unschedule(path)
+            for path in runs.difference(cls.watches, cls.polled):
+                if not cls.polling and cls._schedule(path):
+                    # Files written before the watch
+                    rescans[path] = 0
+                else:
+                    cls.polled[path] = PollScanner(path, True)
+
+    @classmethod
+    def _check_watches(cls, rescans: dict, since: float):
+        "Drop the dead watches, and watch the data directory again if lost"
+        with cls.cond:
+            for path in list(cls.polled):
+                if not os.path.isdir(path):
+                    del cls.polled[path]
+            if cls.polling:
+                return
+            alive = {
+                item.watch for item in upload.OBSERVER.emitters
+                if item.is_alive()
+            }
+            lost = [
+                path for path, watch in cls.watches.items()
+                if watch not in alive or not os.path.isdir(path)
+            ]
+            for path in lost:
+                print("Watch of", path, "lost.", file=sys.stderr, flush=True)
+                cls._unschedule(path)
+            root = common.CONFIG["local"]["data"]
+            if not cls.active and root not in cls.watches and os.path.isdir(
+                root
+            ):
+                if cls._schedule(root):
+                    rescans[root] = since
+                else:
+                    print(
+                        "Watching the directories of active runs only.",
+                        file=sys.stderr, flush=True
+                    )
+                    cls.active = True
+
+    @classmethod
+    def _rescan(cls, path: str, since: float):
+        "Pass the data files under a directory modified since a time on"
+        count = 0
+        for entry in scan_tree(path):
+            try:
+                if entry.stat().st_mtime < since:
+                    continue
+            except OSError:
+                continue  # Removed during the scan
+            FileModifyHandler.intake.add(entry.path, new=True)
+            count += 1
+        if count and common.VERBOSE:
+            print(
+                "Rescan of", path, "found", count, "files.",
+                file=sys.stderr, flush=True
+            )
+
+    @classmethod
+    def _loop(cls):
+        "Keep the watches complete and rescan what they may have missed"
+        checked = time.time()
+        while True:
+            now = time.time()
+            with cls.cond:
+                rescans, cls.rescans = cls.rescans, {}
+            try:
+                # Allow for the files written while checking
+                cls._check_watches(rescans, checked - Monitor.INTERVAL)
+                if cls.active:
+                    cls._sync_runs(rescans)
+                with cls.cond:
+                    scanners = list(cls.polled.values())
+                for scanner in scanners:
+                    scanner.scan()
+                for path, since in rescans.items():
+                    cls._rescan(path, since)
+            except Exception as err:  # pylint: disable=broad-except
+                print(
+                    "Failed to check the watches:", err,
+                    file=sys.stderr, flush=True
+                )
+            checked = now
+            with cls.cond:
+                if not cls.rescans:
+                    cls.cond.wait(
+                        float(common.CONFIG["local"]["poll_interval"])
+                        if cls.polling else Monitor.INTERVAL
+                    )
+
+
+# pylint: disable=protected-access
+FileModifyHandler.settler = Settler(FileModifyHandler._handle_signal_file)
+FileModifyHandler.intake = EventIntake(
+    FileModifyHandler._handle_batch, Monitor.overflow
+)
+# pylint: enable=protected-access
+upload.UploadTask.give_up_hook.add(FileModifyHandler.dedup.discard)
+
+
+def _handle_run_start(path: str, run_info: dict):
+    "Create the run as soon as MinKNOW reports it"
+    upload.QUEUE.put(upload.CreateRunTask(path, run_info))
 
 
 def start_monitor():
     "setup watchdog to monitor the path"
-    observer = watchdog.observers.Observer()
-    event_handler = FileModifyHandler()
-    observer.schedule(
-        event_handler, common.CONFIG["local"]["data"],
-        recursive=True
-    )
-    observer.start()
+    if common.CONFIG["local"]["monitor"] == "poll" and (
+        common.CONFIG["local"]["watch"] != "active"
+    ):
+        upload.OBSERVER = PollScanner(common.CONFIG["local"]["data"])
+        upload.OBSERVER.start()
+    else:
+        Monitor.start()
     print(
         "Start monitoring "+common.CONFIG["local"]["data"],
         file=sys.stderr, flush=True
     )
-    upload.OBSERVER = observer
+
+
+def scan_tree(root: str):
+    "Iterate over the os.DirEntry of every data file under root"
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1] in DATA_EXT:
+                        yield entry
+        except OSError as err:
+            print("Cannot scan", err, file=sys.stderr, flush=True)
+
+
+def backfill():
+    "Queue the recent data files missed while the daemon was not running"
+    # Resume the journaled uploads, including those left being finalized
+    for item in common.DATABASE.get_uploads():
+        if os.path.isfile(item[0]):
+            FileModifyHandler.intake.add(item[0], new=True)
+    hours = float(common.CONFIG["local"]["backfill_hours"])
+    if hours <= 0:
+        return
+    cutoff = time.time() - hours * 3600
+    uploaded = common.DATABASE.get_files()
+    count = 0
+    for entry in scan_tree(common.CONFIG["local"]["data"]):
+        if entry.path in uploaded:
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                continue
+        except OSError:
+            continue  # Removed during the scan
+        FileModifyHandler.intake.add(entry.path, new=True)
+        count += 1
+    print(
+        "Backfill scan found", count, "files not uploaded yet.",
+        file=sys.stderr, flush=True
+    )
 
 
 def stop_monitor(sig: int, _):
@@ -153,14 +942,31 @@ def stop_monitor(sig: int, _):
 
 def main():
     "main invocation to start the upload daemon"
+    common.SESSION = common.SharedSession()
+    upload.FINALIZER = upload.Finalizer()
+    if common.CONFIG["local"].getboolean("minknow_watch"):
+        staphminknow.MinKnow.run_hook.add(_handle_run_start)
+        staphminknow.MinKnow.watch()
     start_monitor()
+    # Catch up with the files written before the monitor started
+    threading.Thread(target=backfill, name="backfill", daemon=True).start()
     # Signal handling for end of life
     signal.signal(signal.SIGINT, stop_monitor)
     signal.signal(signal.SIGTERM, stop_monitor)
-    # Upload loop
-    while True:
-        task = upload.QUEUE.get()
-        if task is None:
-            break
-        task.upload()
+    if common.CONFIG["cloud"]["engine"] == "asyncio":
+        # Single event loop in place of the worker pool
+        aioupload.main()
+    else:
+        # Upload worker pool
+        workers = [
+            threading.Thread(target=upload.worker, name="upload-"+str(index))
+            for index in range(int(common.CONFIG["cloud"]["workers"]))
+        ]
+        for item in workers:
+            item.start()
+        for item in workers:
+            item.join()
+    common.SESSION.close()
+    common.DATABASE.close()
+    print(common.format_metrics(), file=sys.stderr, flush=True)
     print("Daemon terminated successfully.", file=sys.stderr, flush=True)
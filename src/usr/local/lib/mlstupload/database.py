@@ -2,24 +2,74 @@
 
 "Run information database handler - sqlite3 based"
 
+import os
 import sqlite3
+import sys
+import threading
+import urllib.parse as up
 
 from . import common
 
-SCHEMA = (
-    "CREATE TABLE run "
-    "(local text primary key, remote text unique, uploaded int)"
-)
+SCHEMA = {
+    "run": (
+        "CREATE TABLE run "
+        "(local text primary key, remote text unique, uploaded int)"
+    ),
+    # Journal of files being uploaded, for resuming after a restart.
+    # The SHA-256 is set once the file is closed and being finalized.
+    "upload": (
+        "CREATE TABLE upload "
+        "(path text primary key, token text, size int, mtime int, "
+        "encoding text, sha256 text)"
+    ),
+    # Byte ranges acknowledged by the upload server
+    "chunk": (
+        "CREATE TABLE chunk "
+        "(path text, start int, end int, primary key (path, start))"
+    ),
+    # Files successfully uploaded and submitted, with their SHA-256
+    "file": (
+        "CREATE TABLE file "
+        "(path text primary key, size int, mtime int, sha256 text)"
+    ),
+    # Content fingerprints of uploaded files, to skip identical ones
+    "content": (
+        "CREATE TABLE content "
+        "(path text primary key, run text, size int, partial text, "
+        "sha256 text)"
+    )
+}
 
 
 class RunDB:
-    "Run Database class to handle run mapping information"
+    """Run Database class to handle run mapping information
+
+The connection is shared by all upload workers, so every access to it is
+serialized with the instance lock.
+
+The database is kept in WAL mode. Frequent writes are held back and
+written in a single transaction every [local] db_flush seconds. Each is
+held under the path of the file it is about, and reads by path write out
+only the changes of that path first, while acknowledged chunks and
+content fingerprints not written yet are looked up in memory, so reads
+always see them. Upload counters are added up in memory as well. A
+read-only instance opens the database with a read-only connection, so
+status queries never block the daemon.
+"""
+    CLEAR_CHUNKS = "DELETE FROM chunk WHERE path=?"
+    ADD_CHUNK = "INSERT OR REPLACE INTO chunk VALUES (?,?,?)"
+    DROP_CHUNKS = "DELETE FROM chunk WHERE path=? AND start<? AND end>?"
 
     def __init__(self, readonly: bool = False):
         assert common.CONFIG is not None, "Config not loaded before database"
         self.src = None
         self.conn = None
         self.readonly = readonly
+        self.lock = threading.RLock()
+        self.pending = []
+        self.increments = {}
+        self.flusher = None
+        self.closed = threading.Event()
         common.CONFIG.update_hook.add(self.reload)
         self.reload()
 
@@ -30,72 +80,319 @@ class RunDB:
         if self.src == path:
             # No need to reload. We still use the same DB
             return
+        with self.lock:
+            if self.conn is not None:
+                self.flush()
+            self._load(path)
+
+    def _load(self, path: str):
+        "Open the database at path, replacing the current connection"
         if self.conn is not None:
             # Changed database location. Clean up old one
             self.conn.rollback()
             self.conn.close()
             if common.VERBOSE:
                 print("Previous database", self.src, "rolled back")
-        self.conn = sqlite3.connect(path)
-        cur = self.conn.cursor()
-        check = cur.execute(
-            "SELECT sql FROM sqlite_schema WHERE type=? AND name=?",
-            ("table", "run")
-        ).fetchone()
-        if check and check[0] == SCHEMA:
-            # Check passed. Rollback db and move on.
-            self.conn.rollback()
-            return
-        if check and check[0] != SCHEMA:
-            # Check failed - previous run table had a different schema
-            if self.readonly:
-                raise PermissionError(
-                    "Cannot update schema due to read-only DB"
-                )
-            cur.execute("DROP TABLE run")
         # If we don't have the DB in the first place
         # we can still create the DB even in read-only mode.
-        cur.execute(SCHEMA)
+        read_only = self.readonly and os.path.isfile(path)
+        if read_only:
+            self.conn = sqlite3.connect(
+                "file:"+up.quote(path)+"?mode=ro",
+                uri=True, check_same_thread=False
+            )
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.src = path
+        cur = self.conn.cursor()
+        for table, schema in SCHEMA.items():
+            check = cur.execute(
+                "SELECT sql FROM sqlite_schema WHERE type=? AND name=?",
+                ("table", table)
+            ).fetchone()
+            if check and check[0] == schema:
+                # Check passed. Move on.
+                continue
+            if read_only or (check and check[0] != schema):
+                # Check failed - table missing or with a different schema
+                if self.readonly:
+                    self.conn.rollback()
+                    raise PermissionError(
+                        "Cannot update schema due to read-only DB"
+                    )
+                cur.execute("DROP TABLE "+table)
+            cur.execute(schema)
         self.conn.commit()
 
     def __enter__(self):
         # Activate the database
+        self.lock.acquire()
         return self.conn.cursor()
 
     def __exit__(self, err, *_):
         # Clean up the database connection
-        if err is not None or self.readonly:
-            self.conn.rollback()
-        else:
-            self.conn.commit()
+        try:
+            if err is not None or self.readonly:
+                self.conn.rollback()
+            else:
+                self.conn.commit()
+        finally:
+            self.lock.release()
+
+    def _defer(self, path: str, *statements):
+        "Queue (sql, parameters) statements about a path for the next write"
+        assert not self.readonly, "Read only database"
+        with self.lock:
+            self.pending.extend(item + (path,) for item in statements)
+            self._schedule()
+
+    def _schedule(self):
+        "Make sure the pending changes would be written"
+        if float(common.CONFIG["local"]["db_flush"]) <= 0:
+            self.flush()
+        elif self.flusher is None:
+            self.flusher = threading.Thread(
+                target=self._flush_loop, name="rundb", daemon=True
+            )
+            self.flusher.start()
+
+    def _flush_loop(self):
+        "Write the pending changes at regular intervals till closed"
+        while not self.closed.wait(float(common.CONFIG["local"]["db_flush"])):
+            try:
+                self.flush()
+            except sqlite3.Error as err:
+                print(
+                    "Failed to write database:", err,
+                    file=sys.stderr, flush=True
+                )
+
+    def flush(self, path: str = None):
+        """Write the pending changes in a single transaction
+
+If path is given, only the changes about that path are written.
+"""
+        with self.lock:
+            statements = [
+                item for item in self.pending
+                if path is None or item[2] == path
+            ]
+            if not statements and (path is not None or not self.increments):
+                return
+            try:
+                cur = self.conn.cursor()
+                for item in statements:
+                    cur.execute(item[0], item[1])
+                if path is None:
+                    cur.executemany(
+                        "UPDATE run SET uploaded=uploaded+? WHERE local=?",
+                        [
+                            (item[1], item[0])
+                            for item in self.increments.items()
+                        ]
+                    )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            if path is None:
+                self.pending = []
+                self.increments = {}
+            else:
+                self.pending = [
+                    item for item in self.pending if item[2] != path
+                ]
+
+    def close(self):
+        "Write the pending changes and stop the batched writer"
+        self.closed.set()
+        self.flush()
 
     def get_run(self, local_id: str) -> tuple:
         "Get remote run id from local id, return None if not present"
-        cur = self.conn.cursor()
-        data = cur.execute(
-            "SELECT remote,uploaded FROM run WHERE local=?", (local_id,)
-        ).fetchone()
-        self.conn.rollback()
+        with self.lock:
+            cur = self.conn.cursor()
+            data = cur.execute(
+                "SELECT remote,uploaded FROM run WHERE local=?", (local_id,)
+            ).fetchone()
+            self.conn.rollback()
+            if data is not None and local_id in self.increments:
+                # Count the uploads not written yet
+                data = (data[0], data[1] + self.increments[local_id])
         return data
 
     def create_run(self, local_id: str, remote_id: str):
         "Create a new run entry"
         assert not self.readonly, "Read only database"
-        cur = self.conn.cursor()
-        cur.execute(
-            "INSERT INTO run VALUES (?,?,?)", (local_id, remote_id, 0)
-        )
-        self.conn.commit()
+        with self:
+            self.conn.execute(
+                "INSERT INTO run VALUES (?,?,?)", (local_id, remote_id, 0)
+            )
 
     def increment_run(self, local_id: str) -> int:
         "Increment the number of files uploaded"
         assert not self.readonly, "Read only database"
-        cur = self.conn.cursor()
-        cur.execute(
-            "UPDATE run SET uploaded=uploaded+1 WHERE local=?", (local_id,)
+        with self.lock:
+            self.increments[local_id] = self.increments.get(local_id, 0) + 1
+            self._schedule()
+            return self.get_run(local_id)[1]
+
+    def get_upload(self, path: str) -> tuple:
+        """Get the journaled upload of a file, None if absent
+
+Returns (token, size, mtime, encoding, sha256), encoding being empty if
+the file is sent uncompressed and sha256 None unless it was closed.
+"""
+        self.flush(path)
+        with self as cur:
+            data = cur.execute(
+                "SELECT token,size,mtime,encoding,sha256 FROM upload "
+                "WHERE path=?",
+                (path,)
+            ).fetchone()
+        return data
+
+    def start_upload(
+        self, path: str, token: str, size: int, mtime: int,
+        encoding: str = ""
+    ):
+        "Journal a new upload of a file, dropping any previous progress"
+        self._defer(
+            path,
+            (RunDB.CLEAR_CHUNKS, (path,)),
+            (
+                "INSERT OR REPLACE INTO upload VALUES (?,?,?,?,?,NULL)",
+                (path, token, size, mtime, encoding)
+            )
         )
-        data = cur.execute(
-            "SELECT uploaded FROM run WHERE local=?", (local_id,)
-        ).fetchone()[0]
-        self.conn.commit()
+
+    def close_upload(self, path: str, sha256: str):
+        "Journal a file as closed, the upload server finalizing it"
+        self._defer(
+            path,
+            ("UPDATE upload SET sha256=? WHERE path=?", (sha256, path))
+        )
+
+    def ack_chunk(self, path: str, start: int, end: int):
+        "Record a byte range of a file acknowledged by the upload server"
+        self._defer(path, (RunDB.ADD_CHUNK, (path, start, end)))
+
+    def drop_chunks(self, path: str, ranges: list):
+        "Forget the acknowledged chunks of a file overlapping byte ranges"
+        self._defer(path, *(
+            (RunDB.DROP_CHUNKS, (path, end, start)) for start, end in ranges
+        ))
+
+    def get_chunks(self, path: str) -> list:
+        "Get the acknowledged byte ranges of a file, sorted by offset"
+        with self as cur:
+            data = dict(cur.execute(
+                "SELECT start,end FROM chunk WHERE path=?", (path,)
+            ).fetchall())
+            # Chunks not written yet
+            for item in self.pending:
+                if item[2] != path:
+                    continue
+                if item[0] == RunDB.CLEAR_CHUNKS:
+                    data = {}
+                elif item[0] == RunDB.ADD_CHUNK:
+                    data[item[1][1]] = item[1][2]
+                elif item[0] == RunDB.DROP_CHUNKS:
+                    data = {
+                        start: end for start, end in data.items()
+                        if not (start < item[1][1] and end > item[1][2])
+                    }
+        return sorted(data.items())
+
+    def drop_upload(self, path: str):
+        "Remove a file from the upload journal"
+        self._defer(
+            path,
+            (RunDB.CLEAR_CHUNKS, (path,)),
+            ("DELETE FROM upload WHERE path=?", (path,))
+        )
+
+    def finish_upload(self, path: str, sha256: str = None):
+        "Move a file from the upload journal to the uploaded file record"
+        self._defer(
+            path,
+            (
+                "INSERT OR REPLACE INTO file "
+                "SELECT path,size,mtime,? FROM upload WHERE path=?",
+                (sha256, path)
+            ),
+            (RunDB.CLEAR_CHUNKS, (path,)),
+            ("DELETE FROM upload WHERE path=?", (path,))
+        )
+
+    def record_file(self, path: str, size: int, mtime: int, sha256: str):
+        "Record a file as uploaded without going through the journal"
+        self._defer(path, (
+            "INSERT OR REPLACE INTO file VALUES (?,?,?,?)",
+            (path, size, mtime, sha256)
+        ))
+
+    def add_content(
+        self, path: str, run: str, size: int, partial: str, sha256: str
+    ):
+        "Record the content fingerprint of a file uploaded for a run"
+        self._defer(path, (
+            "INSERT OR REPLACE INTO content VALUES (?,?,?,?,?)",
+            (path, run, size, partial, sha256)
+        ))
+
+    def find_content(self, run: str, size: int, partial: str) -> list:
+        "Get the (path, sha256) of the files of a run with a fingerprint"
+        with self as cur:
+            data = dict(cur.execute(
+                "SELECT path,sha256 FROM content "
+                "WHERE run=? AND size=? AND partial=?",
+                (run, size, partial)
+            ).fetchall())
+            # Fingerprints not written yet
+            for item in self.pending:
+                if item[0].startswith("INSERT OR REPLACE INTO content"):
+                    if item[1][1:4] == (run, size, partial):
+                        data[item[1][0]] = item[1][4]
+                    else:
+                        data.pop(item[1][0], None)
+        return list(data.items())
+
+    def is_uploaded(self, path: str, size: int, mtime: int) -> bool:
+        "Check if a file of the same path, size and mtime was uploaded"
+        self.flush(path)
+        with self as cur:
+            data = cur.execute(
+                "SELECT size,mtime FROM file WHERE path=?", (path,)
+            ).fetchone()
+        return data == (size, mtime)
+
+    def get_files(self) -> set:
+        "Get the paths of all uploaded files"
+        self.flush()
+        with self as cur:
+            data = {item[0] for item in cur.execute("SELECT path FROM file")}
+        return data
+
+    def get_runs(self) -> list:
+        "Get the (local id, remote id, files uploaded) of every run"
+        self.flush()
+        with self as cur:
+            data = cur.execute(
+                "SELECT local,remote,uploaded FROM run ORDER BY local"
+            ).fetchall()
+        return data
+
+    def get_uploads(self) -> list:
+        "Get the (path, size, bytes acknowledged) of the journaled uploads"
+        self.flush()
+        with self as cur:
+            data = cur.execute(
+                "SELECT upload.path,upload.size,"
+                "coalesce(sum(chunk.end-chunk.start),0) FROM upload "
+                "LEFT JOIN chunk ON chunk.path=upload.path "
+                "GROUP BY upload.path ORDER BY upload.path"
+            ).fetchall()
         return data
@@ -0,0 +1,127 @@
+#! /usr/bin/python3
+
+"""Local stand-in for minknow_api to run without a sequencer
+
+Only the part of the manager and flow cell position interface used by
+staphminknow is provided. Positions are added with add_position(), and
+runs are started and stopped on them to drive the watch streams:
+
+    position = add_position("X1", "MN12345")
+    position.start_run("run-id", "/var/lib/minknow/data/exp/sample/run")
+    position.stop_run()
+"""
+
+import copy
+import threading
+import time
+import types
+
+POSITIONS = {}
+
+
+class Field:
+    "Message field holding a single value"
+
+    def __init__(self, value):
+        self.value = value
+
+
+class ProtocolRunInfo:
+    "Subset of the protocol run info message"
+
+    def __init__(
+        self, run_id: str, output_path: str, device_id: str,
+        protocol_id: str, group: str
+    ):
+        self.run_id = run_id
+        self.output_path = output_path
+        self.protocol_id = protocol_id
+        self.device = types.SimpleNamespace(device_id=device_id)
+        self.user_info = types.SimpleNamespace(protocol_group_id=Field(group))
+        self.start_time = time.time()
+        self.end_time = None
+
+    def HasField(self, name: str) -> bool:  # pylint: disable=invalid-name
+        "Check if an optional field is set"
+        return getattr(self, name) is not None
+
+
+class ProtocolService:
+    "Protocol service of a position"
+
+    def __init__(self, position):
+        self.position = position
+
+    def get_run_info(self) -> ProtocolRunInfo:
+        "Get the current or last protocol run"
+        if self.position.run is None:
+            raise RuntimeError("No protocol run on "+self.position.name)
+        return self.position.run
+
+    def watch_current_protocol_run(self):
+        "Stream the current protocol run, waiting for one to start"
+        # Yield copies outside the lock, not to block start_run and stop_run
+        with self.position.cond:
+            while self.position.run is None or self.position.run.HasField(
+                "end_time"
+            ):
+                self.position.cond.wait()
+            run = self.position.run
+            state = copy.copy(run)
+        yield state
+        with self.position.cond:
+            while not run.HasField("end_time"):
+                self.position.cond.wait()
+            state = copy.copy(run)
+        yield state
+
+
+class Position:
+    "Flow cell position"
+
+    def __init__(self, name: str, device_id: str):
+        self.name = name
+        self.device_id = device_id
+        self.run = None
+        self.cond = threading.Condition()
+
+    def connect(self):
+        "Connect to the position"
+        return types.SimpleNamespace(protocol=ProtocolService(self))
+
+    def start_run(
+        self, run_id: str, output_path: str,
+        protocol_id: str = "sequencing/sequencing_MIN114_DNA_e8_2_400K:"
+        "FLO-MIN114:SQK-RBK114-96",
+        group: str = "debug"
+    ):
+        "Start a sequencing protocol run"
+        with self.cond:
+            self.run = ProtocolRunInfo(
+                run_id, output_path, self.device_id, protocol_id, group
+            )
+            self.cond.notify_all()
+
+    def stop_run(self):
+        "Stop the current protocol run"
+        with self.cond:
+            if self.run is not None:
+                self.run.end_time = time.time()
+            self.cond.notify_all()
+
+
+class Manager:
+    "Connection to the MinKNOW manager"
+
+    def flow_cell_positions(self) -> list:
+        "List all flow cell positions"
+        return list(POSITIONS.values())
+
+
+def add_position(name: str, device_id: str) -> Position:
+    "Add a flow cell position to the fake manager"
+    POSITIONS[name] = Position(name, device_id)
+    return POSITIONS[name]
+
+
+manager = types.SimpleNamespace(Manager=Manager)
@@ -6,6 +6,7 @@ import hashlib
 import importlib
 import os
 import sys
+import threading
 import time
 
 from . import common
@@ -20,10 +21,36 @@ except ImportError:
 
 
 class MinKnow:
-    "MinKnow wrapper to get run information from API"
+    """MinKnow wrapper to get run information from API
+
+Run info is cached by output path. A run stays cached for
+[local] minknow_ttl seconds after MinKNOW stopped reporting it, and a
+path without a run is remembered for [local] minknow_miss_ttl seconds
+before MinKNOW is queried again. Concurrent cache misses share a single
+refresh of all positions.
+
+With watch(), the protocol runs of every position are followed as they
+start and stop, and the functions in run_hook are called with the output
+path and run info of every newly started run.
+
+Resolved run info is also indexed by the directory of the data file, so
+that further files of the directory take a single lookup. Entries are
+dropped when their run starts again or ends, and on every refresh unless
+the run is still cached unchanged. Run info estimated while MinKNOW is
+unreachable expires with the retry delay, and is dropped on any refresh
+or run state change.
+"""
     DEFAULT_BARCODE_KIT = "SQK-NBD112-96"
     data = {}
+    seen = {}
+    missing = {}
+    index = {}
     updated = 0
+    failed = 0
+    lock = threading.Lock()
+    update_lock = threading.Lock()
+    run_hook = set()
+    watched = set()
 
     @staticmethod
     def _sequencer_filter(name: str) -> bool:
@@ -107,20 +134,164 @@ class MinKnow:
                 runinfo = cls._get_basecall_param(info)
                 if runinfo is not None:
                     result[runpath] = runinfo
-        cls.data = result
-        cls.updated = time.time()
+        with cls.update_lock:
+            now = time.time()
+            ttl = float(common.CONFIG["local"]["minknow_ttl"])
+            for item in result:
+                cls.seen[item] = now
+            for item in [
+                item for item in cls.seen.items() if item[1] + ttl < now
+            ]:
+                # Run finished long enough ago
+                del cls.seen[item[0]]
+            data = {
+                item[0]: item[1] for item in cls.data.items()
+                if item[0] in cls.seen
+            }
+            data.update(result)
+            cls.data = data
+            cls.index = {
+                item[0]: item[1] for item in cls.index.items()
+                if item[1][0] is not None
+                and data.get(item[1][0]) == item[1][1]
+            }
+            cls.missing = {
+                item[0]: item[1] for item in cls.missing.items()
+                if item[0] not in data
+            }
+            cls.updated = now
+
+    @classmethod
+    def _track(cls, info):
+        "Update the cache from a protocol run state change"
+        if not (
+            cls._sequencer_filter(info.device.device_id)
+            and info.protocol_id.startswith("sequencing/")
+        ):
+            return
+        runpath = os.path.normpath(info.output_path)
+        with cls.update_lock:
+            # Ended runs expire minknow_ttl after their end
+            cls.seen[runpath] = time.time()
+            cls.index = {
+                item[0]: item[1] for item in cls.index.items()
+                if item[1][0] not in (runpath, None)
+            }
+            if info.HasField("end_time") or (
+                runpath in cls.data and cls.data[runpath]["id"] == info.run_id
+            ):
+                return
+            runinfo = cls._get_basecall_param(info)
+            if runinfo is None:
+                return
+            data = dict(cls.data)
+            data[runpath] = runinfo
+            cls.data = data
+            cls.missing.pop(runpath, None)
+        print(
+            "Sequencing run started at", runpath, file=sys.stderr, flush=True
+        )
+        for item in cls.run_hook:
+            item(runpath, runinfo)
+
+    @classmethod
+    def _watch_position(cls, position):
+        "Follow the protocol runs of a flow cell position"
+        delay = 1
+        while True:
+            try:
+                protocol = position.connect().protocol
+                for info in protocol.watch_current_protocol_run():
+                    delay = 1
+                    cls._track(info)
+            except Exception as error:  # pylint: disable=broad-except
+                print(
+                    "Watching position", position.name, "failed.", error,
+                    file=sys.stderr, flush=True
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    @classmethod
+    def _watch_positions(cls, interval: float):
+        "Start following every flow cell position as it appears"
+        while True:
+            try:
+                manager = MINKNOW_API.manager.Manager()
+                for item in manager.flow_cell_positions():
+                    if item.name not in cls.watched:
+                        cls.watched.add(item.name)
+                        threading.Thread(
+                            target=cls._watch_position, args=(item,),
+                            name="minknow-"+item.name, daemon=True
+                        ).start()
+            except Exception as error:  # pylint: disable=broad-except
+                print(
+                    "Listing positions failed.", error,
+                    file=sys.stderr, flush=True
+                )
+            time.sleep(interval)
+
+    @classmethod
+    def watch(cls, interval: float = 60):
+        "Keep the cache updated from MinKNOW acquisition state streams"
+        threading.Thread(
+            target=cls._watch_positions, args=(interval,),
+            name="minknow", daemon=True
+        ).start()
+
+    @classmethod
+    def _index_run(
+        cls, folder: str, runpath: str, runinfo: dict, expires: float = None
+    ) -> dict:
+        """Index the run info of a directory, return the run info
+
+The runpath of estimated run info is None, and it expires at a time.
+"""
+        with cls.update_lock:
+            if runpath is None or cls.data.get(runpath) is runinfo:
+                cls.index[folder] = (runpath, runinfo, expires)
+        return runinfo
 
     @classmethod
     def get_run_info(cls, path: str, from_root: bool = False) -> dict:
         "Get run info for the path of the data file"
-        data_path = path if from_root else os.path.dirname(os.path.dirname(path))
+        folder = path if from_root else os.path.dirname(path)
+        entry = cls.index.get(folder)
+        if entry is not None and (entry[2] is None or entry[2] > time.time()):
+            return entry[1]
+        data_path = folder if from_root else os.path.dirname(folder)
         if data_path in cls.data:
-            return cls.data[data_path]
-        try:
-            cls.refresh()
-        except Exception as error:  # pylint: disable=broad-except
-            print("Updating sequencer position info failed.", error, file=sys.stderr, flush=True)
-            return cls._get_default_param(path)
+            return cls._index_run(folder, data_path, cls.data[data_path])
+        miss_ttl = float(common.CONFIG["local"]["minknow_miss_ttl"])
+        if cls.missing.get(data_path, 0) + miss_ttl > time.time():
+            # Recently confirmed not to be a sequencing run
+            return None
+        if cls.failed + miss_ttl > time.time():
+            # MinKNOW recently unreachable. Do not retry for every file.
+            return cls._index_run(
+                folder, None, cls._get_default_param(path),
+                cls.failed + miss_ttl
+            )
+        started = time.time()
+        with cls.lock:
+            # Only refresh if no other thread did, or failed to, while we
+            # were waiting
+            if cls.updated < started and cls.failed < started:
+                try:
+                    cls.refresh()
+                except Exception as error:  # pylint: disable=broad-except
+                    print(
+                        "Updating sequencer position info failed.", error,
+                        file=sys.stderr, flush=True
+                    )
+                    cls.failed = time.time()
+            if cls.failed >= started:
+                return cls._index_run(
+                    folder, None, cls._get_default_param(path),
+                    cls.failed + miss_ttl
+                )
         if data_path in cls.data:
-            return cls.data[data_path]
+            return cls._index_run(folder, data_path, cls.data[data_path])
+        cls.missing[data_path] = time.time()
         return None
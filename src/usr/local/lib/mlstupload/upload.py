@@ -2,47 +2,668 @@
 
 "Upload Task Handler"
 
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import importlib
+import itertools
 import json
 import os
-import queue
+import random
 import sys
+import threading
 import time
+import traceback
 import urllib.parse as up
+import zlib
 
 from . import common
 
-OBSERVER = None
-QUEUE = queue.Queue()
-
-
-def upload_file(token: str, filepath: str, bs=2097152):
-    "Upload a file in small chunks to remote server"
-    time.sleep(0.5)
-    with open(filepath, "rb") as stdin:
-        block = stdin.read(bs)
-        count = 0
-        while block != b"":
-            # Send this block to upload server
-            common.WebRequest.request_file(
-                "PUT",
-                "cgi-bin/upload.py",
-                fields={
-                    "file": ("blob", block, "application/octet-stream"),
-                    "range": str(count*bs)+"-"+str(count*bs+len(block)),
-                    "session": token
-                }
+# Optional zstd support for compressed uploads
+try:
+    ZSTD = importlib.import_module("zstandard")
+except ImportError:
+    ZSTD = None
+
+
+class TaskQueue:
+    """Priority scheduler of upload tasks, used in place of queue.Queue
+
+Once the termination sentinel None is put, every get() returns None, so
+that workers stop after their current task. Otherwise run creation tasks
+are taken first, then upload tasks round-robin across runs so that every
+run gets its first files uploaded early. Within a run, [local]
+queue_policy picks the next file: fifo, smallest or oldest.
+"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.urgent = collections.deque()
+        self.runs = collections.OrderedDict()
+        self.counter = itertools.count()
+
+    @staticmethod
+    def _key(task) -> float:
+        "Get the sort key of an upload task within its run"
+        policy = common.CONFIG["local"]["queue_policy"]
+        if policy == "smallest":
+            return task.size
+        if policy == "oldest":
+            return task.mtime
+        return 0
+
+    def put(self, task):
+        "Schedule a task"
+        with self.cond:
+            if task is None:
+                self.stopped = True
+                self.cond.notify_all()
+                return
+            if isinstance(task, UploadTask):
+                heapq.heappush(
+                    self.runs.setdefault(task.conf["id"], []),
+                    (self._key(task), next(self.counter), task)
+                )
+            else:
+                self.urgent.append(task)
+            self.cond.notify()
+
+    def get(self):
+        "Wait for the next task to run"
+        with self.cond:
+            while True:
+                if self.stopped:
+                    return None
+                if self.urgent:
+                    return self.urgent.popleft()
+                if self.runs:
+                    run_id, tasks = self.runs.popitem(last=False)
+                    task = heapq.heappop(tasks)[2]
+                    if tasks:
+                        # Back of the line for the next round
+                        self.runs[run_id] = tasks
+                    return task
+                self.cond.wait()
+
+    def qsize(self) -> int:
+        "Get the number of tasks waiting"
+        with self.cond:
+            return len(self.urgent) + sum(
+                len(item) for item in self.runs.values()
             )
-            print("=", end="", file=sys.stderr, flush=True)
-            # Get next block ready
-            block = stdin.read(bs)
-            count += 1
+
+
+class Quota:
+    """Per-run accounting of the [local] max_data file limit
+
+The number of files uploaded for a run is read from RunDB once, then
+counted in memory together with the files reserved by queued or running
+tasks. Files past the limit are thus never queued, and concurrent
+uploads cannot overshoot it.
+"""
+
+    def __init__(self):
+        self.uploaded = {}
+        self.reserved = {}
+        self.full = set()
+        self.lock = threading.Lock()
+
+    def reserve(self, run_id: str) -> bool:
+        "Reserve an upload for a run, False if its limit is reached"
+        limit = common.CONFIG["local"]["max_data"]
+        with self.lock:
+            if run_id not in self.uploaded:
+                mapping = common.DATABASE.get_run(run_id)
+                self.uploaded[run_id] = 0 if mapping is None else mapping[1]
+            reserved = self.reserved.get(run_id, 0)
+            if limit and int(limit) <= self.uploaded[run_id] + reserved:
+                if run_id not in self.full:
+                    # We already have enough data. Skip all other uploads.
+                    print(
+                        "Max file number reached for run", run_id,
+                        file=sys.stderr, flush=True
+                    )
+                    self.full.add(run_id)
+                return False
+            self.full.discard(run_id)
+            self.reserved[run_id] = reserved + 1
+            return True
+
+    def release(self, run_id: str, uploaded: bool):
+        "Release a reservation, counting the upload if it succeeded"
+        with self.lock:
+            self.reserved[run_id] = self.reserved.get(run_id, 1) - 1
+            if uploaded:
+                self.uploaded[run_id] = self.uploaded.get(run_id, 0) + 1
+
+
+OBSERVER = None
+QUEUE = TaskQueue()
+QUOTA = Quota()
+FINALIZER = None
+RUN_LOCKS = {}
+RUN_LOCKS_GUARD = threading.Lock()
+
+
+class BufferPool:
+    """Pool of reusable block buffers
+
+Blocks are read into buffers taken from the pool and sent from views of
+them, so that no new bytes object is created per block. At most limit
+idle buffers are kept for reuse.
+"""
+
+    def __init__(self):
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        "Get a buffer of at least size bytes"
+        with self.lock:
+            for index, item in enumerate(self.free):
+                if len(item) >= size:
+                    return self.free.pop(index)
+        return bytearray(size)
+
+    def release(self, buffer: bytearray, limit: int):
+        "Return a buffer to the pool"
+        with self.lock:
+            if len(self.free) < limit:
+                self.free.append(buffer)
+
+
+BUFFERS = BufferPool()
+
+
+class BlockSizer:
+    """Adaptive block size controller
+
+With [cloud] adaptive_block, the block size is doubled while blocks are
+acknowledged in less than half of TARGET seconds, and halved when they
+take more than twice as long or fail, within [cloud] block_size_min and
+block_size_max. Otherwise [cloud] block_size is always used. The size
+learnt is shared by all workers and kept across files.
+"""
+    TARGET = 2.0
+
+    def __init__(self):
+        self.size = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _bounds() -> tuple:
+        "Get the configured (minimum, maximum) block size"
+        return (
+            int(common.CONFIG["cloud"]["block_size_min"]),
+            int(common.CONFIG["cloud"]["block_size_max"])
+        )
+
+    def current(self) -> int:
+        "Get the block size to use for the next block"
+        if (
+            self.size is None
+            or not common.CONFIG["cloud"].getboolean("adaptive_block")
+        ):
+            return int(common.CONFIG["cloud"]["block_size"])
+        return self.size
+
+    def report(self, size: int, elapsed: float = None):
+        "Adjust the block size from a block sent in elapsed seconds"
+        if not common.CONFIG["cloud"].getboolean("adaptive_block"):
+            return
+        lower, upper = self._bounds()
+        with self.lock:
+            current = self.current()
+            if elapsed is None or elapsed > BlockSizer.TARGET * 2:
+                # Failed or too slow
+                new_size = current // 2
+            elif elapsed < BlockSizer.TARGET / 2 and size >= current:
+                new_size = current * 2
+            else:
+                new_size = current
+            new_size = min(max(new_size, lower), upper)
+            if new_size != self.size:
+                print(
+                    "Block size set to", new_size,
+                    file=sys.stderr, flush=True
+                )
+            self.size = new_size
+            common.METRICS["block_size"] = new_size
+
+
+SIZER = BlockSizer()
+
+
+class Codec:
+    """Block compression of uploads, enabled with [cloud] compress
+
+Every block is compressed on its own into a complete zstd frame, or a
+gzip member if zstandard is not installed, so that blocks are still sent
+in parallel and resumed by their byte range in the original file. The
+first SAMPLE bytes of a file are compressed beforehand, and files that
+would not shrink below [cloud] compress_ratio, such as VBZ compressed
+pod5, are sent as is. So are single blocks that do not shrink. A file is
+only compressed if the upload server accepts the encoding with its token.
+"""
+    SAMPLE = 1048576
+
+    @classmethod
+    def choose(cls, path: str) -> str:
+        "Pick the encoding of a file, empty to send it uncompressed"
+        if not common.CONFIG["cloud"].getboolean("compress"):
+            return ""
+        with open(path, "rb") as stdin:
+            sample = stdin.read(cls.SAMPLE)
+        if not sample:
+            return ""
+        encoding = "zstd" if ZSTD is not None else "gzip"
+        ratio = len(cls.compress(encoding, sample)) / len(sample)
+        if ratio > float(common.CONFIG["cloud"]["compress_ratio"]):
+            if common.VERBOSE:
+                print(
+                    "Compression ratio", round(ratio, 2), "too poor for",
+                    path, file=sys.stderr, flush=True
+                )
+            return ""
+        return encoding
+
+    @staticmethod
+    def compress(encoding: str, block) -> bytes:
+        "Compress a block into a standalone zstd frame or gzip member"
+        if encoding == "zstd":
+            return ZSTD.ZstdCompressor().compress(block)
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 31
+        )
+        return compressor.compress(block) + compressor.flush()
+
+    @classmethod
+    def encode(cls, encoding: str, block) -> tuple:
+        "Get the (data, encoding) to send for a block"
+        if encoding:
+            data = cls.compress(encoding, block)
+            if len(data) < len(block):
+                return data, encoding
+        return block, ""
+
+
+def read_block(stdin, buffer: bytearray, size: int) -> memoryview:
+    "Read up to size bytes from the current position into buffer"
+    view = memoryview(buffer)[:size]
+    count = 0
+    while count < size:
+        read = stdin.readinto(view[count:])
+        if not read:
+            break
+        count += read
+    return view[:count]
+
+
+def _put_block(
+    token: str, start: int, block: memoryview, encoding: str = ""
+) -> tuple:
+    "Send a single ranged block to the upload server, return its range"
+    rng = str(start)+"-"+str(start+len(block))
+    crc = zlib.crc32(block)
+    data, encoding = Codec.encode(encoding, block)
+    # CRC32 of the original bytes of the range
+    fields = {"range": rng, "session": token, "crc32": format(crc, "08x")}
+    if encoding:
+        # Range of the block in the original file, data compressed
+        fields["encoding"] = encoding
+    fields["file"] = ("blob", data, "application/octet-stream")
+    body, headers = common.multipart_body(fields)
+    common.WebRequest.limiter.consume(len(data))
+    began = time.monotonic()
+    try:
+        req = common.WebRequest.request_file(
+            "PUT",
+            "cgi-bin/upload.py",
+            body=body,
+            headers=headers
+        )
+    except Exception:
+        SIZER.report(len(block))
+        raise
+    if req.status >= 400:
+        SIZER.report(len(block))
+        raise ConnectionError(
+            "Block "+rng+" rejected with status "+str(req.status)
+        )
+    SIZER.report(len(block), time.monotonic() - began)
+    print("=", end="", file=sys.stderr, flush=True)
+    return start, start+len(block)
+
+
+def missing_ranges(size: int, acked: list) -> list:
+    "Get the byte ranges of a file not covered by the acknowledged ranges"
+    missing = []
+    offset = 0
+    for start, end in acked:
+        if start > offset:
+            missing.append((offset, start))
+        offset = max(offset, end)
+    if offset < size:
+        missing.append((offset, size))
+    return missing
+
+
+def mismatched_ranges(status: str) -> list:
+    """Get the byte ranges of a "mismatch <start-end,...>" close status
+
+None is returned for any other status, and an empty list if the upload
+server did not tell which ranges differ.
+"""
+    if not status.lower().startswith("mismatch"):
+        return None
+    return [
+        tuple(int(value) for value in item.split("-"))
+        for item in status[len("mismatch"):].split(",") if item.strip()
+    ]
+
+
+def hash_range(stdin, digest, start: int, end: int):
+    "Feed the bytes of a file from start to end to digest"
+    stdin.seek(start)
+    while start < end:
+        data = stdin.read(min(end - start, 1048576))
+        if not data:
+            break
+        digest.update(data)
+        start += len(data)
+
+
+class Fingerprint:
+    """Content fingerprint to skip files identical to one already uploaded
+
+Files are first told apart by their size and the SHA-256 of their first
+and last SAMPLE bytes. Only when an uploaded file of the same run shares
+both is the whole file hashed, and compared with the SHA-256 recorded
+for that upload.
+"""
+    SAMPLE = 65536
+
+    @classmethod
+    def partial(cls, path: str) -> tuple:
+        "Get the (size, partial hash) of a file"
+        with open(path, "rb") as stdin:
+            size = os.fstat(stdin.fileno()).st_size
+            digest = hashlib.sha256(stdin.read(cls.SAMPLE))
+            if size > cls.SAMPLE:
+                stdin.seek(max(size - cls.SAMPLE, cls.SAMPLE))
+                digest.update(stdin.read())
+        return size, digest.hexdigest()
+
+    @staticmethod
+    def full(path: str) -> str:
+        "Get the SHA-256 of a whole file"
+        digest = hashlib.sha256()
+        with open(path, "rb") as stdin:
+            hash_range(stdin, digest, 0, os.fstat(stdin.fileno()).st_size)
+        return digest.hexdigest()
+
+    @classmethod
+    def duplicate(cls, task) -> str:
+        """Get an identical file uploaded for the run of a task, None if none
+
+The fingerprint of the task must be set. Its sha256 is set as well if
+the whole file had to be hashed.
+"""
+        matches = common.DATABASE.find_content(
+            task.conf["id"], *task.fingerprint
+        )
+        if not matches:
+            return None
+        task.sha256 = cls.full(task.src)
+        for path, sha256 in matches:
+            if sha256 == task.sha256:
+                return path
+        return None
+
+
+def ranges_to_send(filepath: str, size: int) -> list:
+    "Get the byte ranges of a file not acknowledged in its upload journal"
+    acked = common.DATABASE.get_chunks(filepath)
+    gaps = missing_ranges(size, acked)
+    if acked:
+        print(
+            "Resuming", filepath, "with",
+            sum(item[1] - item[0] for item in gaps), "bytes left",
+            file=sys.stderr, flush=True
+        )
+    return gaps
+
+
+def read_hashed(stdin, digest, hashed: int, start: int, end: int) -> tuple:
+    """Read a block into a pooled buffer, feeding the file to digest in order
+
+The bytes from hashed to start, sent before a resume, are hashed first.
+Returns the buffer and the view of the block in it.
+"""
+    hash_range(stdin, digest, hashed, start)
+    buffer = BUFFERS.acquire(end-start)
+    stdin.seek(start)
+    view = read_block(stdin, buffer, end-start)
+    digest.update(view)
+    return buffer, view
+
+
+def plan_blocks(gaps: list, bs: int = None):
+    "Split the byte ranges to send into blocks, sized as they are needed"
+    for gap_start, gap_end in gaps:
+        start = gap_start
+        while start < gap_end:
+            end = min(start + (bs or SIZER.current()), gap_end)
+            yield start, end
+            start = end
+
+
+def upload_file(
+    token: str, filepath: str, bs: int = None, window: int = None,
+    encoding: str = ""
+) -> str:
+    """Upload a file in small chunks to remote server, return its SHA-256
+
+Up to window ranged blocks are kept in flight at once. Completions are
+tracked in file order, and the function only returns once every byte of
+the file has been acknowledged so that the caller may close the upload.
+Blocks are bs bytes long, or as large as SIZER decides if bs is None.
+
+Ranges already acknowledged in the upload journal of the file are not
+sent again, and each newly acknowledged range is journaled on completion,
+those completed along with a failed block included.
+
+Blocks are read into pooled buffers released as soon as they are sent,
+so memory use stays within window blocks whatever the file size.
+
+With an encoding, each block is compressed by Codec before it is sent.
+
+Each block is sent with the CRC32 of its bytes for the upload server to
+check. The SHA-256 of the whole file is computed as blocks are read in
+file order, reading the ranges sent before a resume just for the hash.
+"""
+    if window is None:
+        window = int(common.CONFIG["cloud"]["parallel_chunks"])
+    limit = int(common.CONFIG["cloud"]["workers"]) * max(window, 1)
+    with open(filepath, "rb", buffering=0) as stdin, \
+            concurrent.futures.ThreadPoolExecutor(max(window, 1)) as pool:
+        size = os.fstat(stdin.fileno()).st_size
+        blocks = plan_blocks(ranges_to_send(filepath, size), bs)
+        block = next(blocks, None)
+        digest = hashlib.sha256()
+        hashed = 0
+        pending = {}
+        done = set()
+        queued = []
+        acked = 0
+        while block is not None or pending:
+            # Fill the window with the next blocks
+            while block is not None and len(pending) < window:
+                start, end = block
+                buffer, view = read_hashed(stdin, digest, hashed, start, end)
+                hashed = end
+                pending[pool.submit(
+                    _put_block, token, start, view, encoding
+                )] = buffer
+                queued.append(start)
+                block = next(blocks, None)
+            finished = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )[0]
+            failed = None
+            for item in finished:
+                BUFFERS.release(pending.pop(item), limit)
+                if item.exception() is not None:
+                    failed = failed or item.exception()
+                    continue
+                common.DATABASE.ack_chunk(filepath, *item.result())
+                done.add(item.result()[0])
+            if failed is not None:
+                # Journal the blocks still in flight before giving up
+                for item in concurrent.futures.wait(pending)[0]:
+                    BUFFERS.release(pending.pop(item), limit)
+                    if item.exception() is None:
+                        common.DATABASE.ack_chunk(filepath, *item.result())
+                raise failed
+            # Advance the contiguous acknowledged position
+            while acked < len(queued) and queued[acked] in done:
+                acked += 1
+        hash_range(stdin, digest, hashed, size)
+    assert acked == len(queued), "Upload incomplete"
     print("", file=sys.stderr, flush=True)
+    return digest.hexdigest()
 
 
-def create_run(conf: dict):
-    "Create a new run on the server"
-    mapping = common.DATABASE.get_run(conf["id"])
-    with common.WebRequest() as api:
+def file_form(query: dict) -> dict:
+    "Get the request arguments of a form posted to the FileAPI"
+    return {
+        "method": "POST",
+        "headers": {"Content-Type": "application/x-www-form-urlencoded"},
+        "body": up.urlencode(query).encode("ascii")
+    }
+
+
+def run_form(conf: dict) -> dict:
+    "Get the request arguments to create a run on the web server"
+    return {
+        "method": "POST",
+        "url": "rest/run",
+        "headers": {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": "application/json"
+        },
+        "body": up.urlencode({"name": conf["name"]}).encode("ascii")
+    }
+
+
+def create_query(mapping: tuple) -> dict:
+    "Get the query to create a run on the upload server"
+    return {"id": mapping[0], "action": "create", "type": "rawdata"}
+
+
+def token_query(mapping: tuple, encoding: str) -> dict:
+    "Get the query of an upload token request, flagging the compression"
+    query = {"id": mapping[0], "action": "upload"}
+    if encoding:
+        query["compress"] = encoding
+    return query
+
+
+def close_form(token: str, src: str, sha256: str) -> dict:
+    "Get the request arguments to close an uploaded file with its SHA-256"
+    return dict(file_form({
+        "session": token,
+        "action": "close",
+        "format": os.path.splitext(src)[1][1:].lower(),
+        "sha256": sha256
+    }), url="cgi-bin/upload.py")
+
+
+def finalize_form(token: str) -> dict:
+    "Get the request arguments of the finalization status of an upload"
+    return dict(
+        file_form({"session": token, "action": "finalize"}),
+        url="cgi-bin/upload.py"
+    )
+
+
+def report_form(mapping: tuple, token: str, src: str, status: str) -> dict:
+    "Get the request arguments to report a finalized file to the web server"
+    return {
+        "method": "PUT",
+        "url": os.path.join("rest/upload", mapping[0], token),
+        "headers": {"Content-Type": "application/x-www-form-urlencoded"},
+        "body": up.urlencode({
+            "barcode": "fast5",
+            "file": status,
+            "name": os.path.basename(src)
+        }).encode("ascii")
+    }
+
+
+def submit_query(token: str, mapping: tuple, conf: dict) -> dict:
+    "Get the query to submit an uploaded file for analysis"
+    return {
+        "upload": token,
+        "id": mapping[0],
+        "flowcell": conf["flowcell"],
+        "kit": conf["kit"],
+        "barcode": conf["barcode_kits"]
+    }
+
+
+def file_reply(req, action: str) -> str:
+    "Get the text replied by the FileAPI, raising ConnectionError on errors"
+    if req.status != 200:
+        raise ConnectionError(
+            action+" failed with status "+str(req.status)
+        )
+    return req.data.decode("utf-8").strip()
+
+
+def token_reply(req, src: str, encoding: str) -> tuple:
+    """Get the upload token and encoding of a token request
+
+The server accepts a compressed upload by replying the encoding after the
+token. Otherwise the file is sent uncompressed. None is returned if quota
+is exceeded.
+"""
+    if req.status == 429:
+        print(
+            "Upload server quota exceeded. Skipping", src,
+            file=sys.stderr, flush=True
+        )
+        return None
+    reply = file_reply(req, "Upload token request for "+src).split()
+    if not reply:
+        raise ConnectionError("Upload token request for "+src+" empty")
+    if encoding and reply[1:] != [encoding]:
+        print(
+            "Upload server did not accept", encoding, "compression of",
+            src, file=sys.stderr, flush=True
+        )
+        encoding = ""
+    return reply[0], encoding
+
+
+def _run_lock(run_id: str) -> threading.Lock:
+    "Get the lock serializing run creation for a local run id"
+    with RUN_LOCKS_GUARD:
+        if run_id not in RUN_LOCKS:
+            RUN_LOCKS[run_id] = threading.Lock()
+        return RUN_LOCKS[run_id]
+
+
+def ensure_run(api: common.WebRequest, conf: dict) -> tuple:
+    """Get the remote run mapping, creating the run on the server if needed
+
+Run creation is serialized per run so that concurrent workers uploading
+files of a new run would only create it once on the server.
+"""
+    with _run_lock(conf["id"]):
+        mapping = common.DATABASE.get_run(conf["id"])
         # Connect to the Web API
         # The following segment is for enhanced token
         # user_info = json.loads(api.request(
@@ -54,41 +675,149 @@ def create_run(conf: dict):
         #        "Accept": "application/json"
         #    }
         # ).data.decode("utf-8"))
-        if mapping is None:
-            # Run ID should not exist on remote server. Create it.
-            print(
-                "New run found. Creating run...",
-                file=sys.stderr, flush=True
-            )
-            req = api.request(
-                "POST",
-                "rest/run",
-                body=up.urlencode({"name": conf["name"]}),
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "Accept": "application/json"
-                }
-            )
-            query = json.loads(req.data.decode("utf-8"))
-            mapping = (query["id"], 0)
-            # Record the run_id mapping somewhere
-            common.DATABASE.create_run(conf["id"], query["id"])
-            # Create a new run on uploadServer
-            query = {
-                "session": api.token,
-                "id": mapping[0],
-                "action": "create",
-                "type": "rawdata"
-            }
-            req = api.request_file(
-                "POST",
-                "cgi-bin/createrun.py",
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "Origin": common.WebRequest.webserver
-                },
-                body=up.urlencode(query).encode("ascii")
+        if mapping is not None:
+            return mapping
+        # Run ID should not exist on remote server. Create it.
+        print(
+            "New run found. Creating run...",
+            file=sys.stderr, flush=True
+        )
+        req = api.request(**run_form(conf))
+        mapping = (json.loads(req.data.decode("utf-8"))["id"], 0)
+        # Create a new run on uploadServer
+        file_reply(api.request_form(
+            "cgi-bin/createrun.py", create_query(mapping)
+        ), "Run creation")
+        # Record the run_id mapping somewhere
+        common.DATABASE.create_run(conf["id"], mapping[0])
+        return mapping
+
+
+def create_run(conf: dict):
+    "Create a new run on the server"
+    if common.DATABASE.get_run(conf["id"]) is not None:
+        # Already created, possibly by another worker
+        return
+    with common.session() as api:
+        ensure_run(api, conf)
+
+
+def finalize_status(token: str) -> str:
+    "Ask the upload server for the finalization status of an upload"
+    req = common.WebRequest.request_file(**finalize_form(token))
+    # target_file = json.loads(req.data.decode("utf-8"))
+    # if "init" not in target_file:
+    return file_reply(req, "Finalization of "+token)
+
+
+def backoff(delay: float) -> float:
+    "Get the next polling delay, exponential with jitter"
+    delay = min(delay * 2, Finalizer.MAX_DELAY)
+    return random.uniform(delay / 2, delay)
+
+
+def wait_finalized(token: str) -> str:
+    "Poll the finalization status of an upload till it is done"
+    started = time.time()
+    delay = Finalizer.INITIAL_DELAY
+    status = "finalizing"
+    while status.lower() == "finalizing":
+        if time.time() - started > float(
+            common.CONFIG["cloud"]["finalize_timeout"]
+        ):
+            raise TimeoutError("Finalization of "+token+" timed out")
+        time.sleep(delay)
+        delay = backoff(delay)
+        status = finalize_status(token)
+    return status
+
+
+class Finalizer:
+    """Poller of the uploads being finalized by the upload server
+
+All pending finalizations are polled from one thread, each with its own
+exponential backoff with jitter from INITIAL_DELAY up to MAX_DELAY
+seconds. Finalized uploads are queued as SubmitTask to be reported by a
+worker, and those still finalizing after [cloud] finalize_timeout
+seconds are given up.
+"""
+    INITIAL_DELAY = 1.0
+    MAX_DELAY = 30.0
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = []
+        self.counter = itertools.count()
+        self.thread = None
+
+    def add(self, task):
+        "Start polling for a SubmitTask"
+        with self.cond:
+            heapq.heappush(
+                self.pending, (task.due, next(self.counter), task)
             )
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._loop, name="finalizer", daemon=True
+                )
+                self.thread.start()
+            self.cond.notify()
+
+    def _loop(self):
+        "Poll the pending finalizations as they become due"
+        while True:
+            with self.cond:
+                while not self.pending or self.pending[0][0] > time.time():
+                    self.cond.wait(
+                        self.pending[0][0] - time.time()
+                        if self.pending else None
+                    )
+                task = heapq.heappop(self.pending)[2]
+            try:
+                task.status = finalize_status(task.token)
+            except Exception as err:  # pylint: disable=broad-except
+                print(
+                    "Failed to poll finalization of", task.src, ":", err,
+                    file=sys.stderr, flush=True
+                )
+            if task.status.lower() != "finalizing":
+                QUEUE.put(task)
+            elif time.time() - task.started > float(
+                common.CONFIG["cloud"]["finalize_timeout"]
+            ):
+                print(
+                    "Finalization timed out. Skipping", task.src,
+                    file=sys.stderr, flush=True
+                )
+                task.task.release(False)
+            else:
+                task.delay = backoff(task.delay)
+                task.due = time.time() + task.delay
+                self.add(task)
+
+
+class SubmitTask:
+    "Class to represent the report of an upload being finalized"
+
+    def __init__(self, task, mapping: tuple, token: str):
+        self.src = task.src
+        self.task = task
+        self.mapping = mapping
+        self.token = token
+        self.status = "finalizing"
+        self.started = time.time()
+        self.delay = Finalizer.INITIAL_DELAY
+        self.due = self.started + self.delay
+
+    def upload(self):
+        "Report the finalized file and submit it for analysis"
+        # pylint: disable=protected-access
+        try:
+            self.task._report(self.mapping, self.token, self.status)
+        except BaseException:
+            self.task.release(False)
+            raise
+        self.task.release(True)
 
 
 class CreateRunTask:
@@ -105,170 +834,253 @@ class CreateRunTask:
 
 
 class UploadTask:
-    "Class to represent an upload task"
+    """Class to represent an upload task
 
-    def __init__(self, src: str, conf: dict):
+A task created with reserved=True holds a QUOTA reservation for its run.
+Otherwise one is taken when it is run. The callables in give_up_hook are
+called with the path of a file not uploaded, so that it can be found
+again.
+"""
+    give_up_hook = set()
+
+    def __init__(self, src: str, conf: dict, reserved: bool = False):
         self.src = src
         self.conf = conf
+        self.attempt = 0
+        self.delay = Finalizer.INITIAL_DELAY
+        self.reserved = reserved
+        self.fingerprint = None
+        self.sha256 = None
+        self.stat = None
+        self.resumed = False
+        self.closed = False
+        try:
+            stat = os.stat(src)
+            self.size = stat.st_size
+            self.mtime = stat.st_mtime
+        except OSError:
+            self.size = 0
+            self.mtime = 0
 
     def upload(self):
         "Upload this file to the upload server"
-        src_file = os.path.basename(self.src)
-        src_format = os.path.splitext(src_file)[1][1:].lower()
+        if not self.reserved:
+            if not QUOTA.reserve(self.conf["id"]):
+                return
+            self.reserved = True
+        try:
+            result = self._upload()
+        except BaseException:
+            self.release(False)
+            raise
+        if result is not None:
+            # Neither requeued nor finalizing. Done with the reservation.
+            self.release(result)
 
+    def _upload(self) -> bool:
+        """Upload the file, return if it was uploaded
+
+None is returned if the task was requeued or is waiting for finalization.
+"""
         # Does the run exist on server?
         mapping = common.DATABASE.get_run(self.conf["id"])
-        # Do we have enough data?
-        if (
-            mapping is not None
-            and common.CONFIG["local"]["max_data"]
-            and int(common.CONFIG["local"]["max_data"]) <= mapping[1]
-        ):
-            # We already have enough data. Skip all other uploads.
-            print(
-                "Max file number reached. Skipping", self.src,
-                file=sys.stderr, flush=True
+        plan = self.prepare(mapping)
+        if plan is None:
+            return False
+        upload_token, encoding = plan
+        if upload_token is None:
+            with common.session() as api:
+                # Connect to the Web API till we get upload token
+                mapping = ensure_run(api, self.conf)
+                reply = self._get_token(api, mapping, encoding)
+            if reply is None:
+                return False
+            upload_token, encoding = reply
+            self.start(upload_token, encoding)
+        if self.closed:
+            # Closed before a restart. Only the finalization is left.
+            try:
+                status = finalize_status(upload_token)
+            except ConnectionError as err:
+                if not self.restart(err):
+                    raise
+                return self._upload()
+            return self._submit(mapping, upload_token, status)
+        # Done with the first API call and let the file uploader to proceed
+        try:
+            self.sha256 = upload_file(
+                upload_token, self.src, encoding=encoding
             )
-            return
+        except ConnectionError as err:
+            if not self.restart(err):
+                raise
+            return self._upload()
+        except common.urllib3.exceptions.HTTPError as err:
+            if not self.retry(err):
+                raise
+            return None
+        status = self._close(upload_token)
+        if self.mismatch(status):
+            return self._upload()
+        self.mark_closed()
+        return self._submit(mapping, upload_token, status)
 
-        with common.WebRequest() as api:
-            # Connect to the Web API till we get upload token
-            # The following segment is for enhanced token
-            # user_info = json.loads(api.request(
-            #    "POST",
-            #    "session/info",
-            #    body=up.urlencode({"id": api.token, "sign": "id,flag"})
-            #    headers={
-            #        "Content-Type": "application/x-www-form-urlencoded",
-            #        "Accept": "application/json"
-            #    }
-            # ).data.decode("utf-8"))
-            if mapping is None:
-                # Run ID should not exist on remote server. Create it.
-                print(
-                    "New run found. Creating run...",
-                    file=sys.stderr, flush=True
-                )
-                req = api.request(
-                    "POST",
-                    "rest/run",
-                    body=up.urlencode({"name": self.conf["name"]}),
-                    headers={
-                        "Content-Type": "application/x-www-form-urlencoded",
-                        "Accept": "application/json"
-                    }
-                )
-                query = json.loads(req.data.decode("utf-8"))
-                mapping = (query["id"], 0)
-                # Record the run_id mapping somewhere
-                common.DATABASE.create_run(self.conf["id"], query["id"])
-                # Create a new run on uploadServer
-                query = {
-                    "session": api.token,
-                    "id": mapping[0],
-                    "action": "create",
-                    "type": "rawdata"
-                }
-                req = api.request_file(
-                    "POST",
-                    "cgi-bin/createrun.py",
-                    headers={
-                        "Content-Type": "application/x-www-form-urlencoded",
-                        "Origin": common.WebRequest.webserver
-                    },
-                    body=up.urlencode(query).encode("ascii")
-                )
+    def prepare(self, mapping: tuple) -> tuple:
+        """Get the journaled token and encoding to resume the upload with
 
-            # Run created. Ready to upload.
-            # Start of file upload, obtain an upload token
-            req = api.request_file(
-                "POST",
-                "cgi-bin/createrun.py",
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "Origin": common.WebRequest.webserver
-                },
-                body=up.urlencode({
-                    "session": api.token,
-                    "id": mapping[0],
-                    "action": "upload"
-                }).encode("ascii")
+The token is None for a new upload, and None is returned instead if an
+identical file was already uploaded.
+"""
+        stat = os.stat(self.src)
+        self.stat = (stat.st_size, stat.st_mtime_ns)
+        self.fingerprint = Fingerprint.partial(self.src)
+        journal = common.DATABASE.get_upload(self.src)
+        # Start over if the file changed since the journaled upload
+        self.resumed = (
+            mapping is not None and journal is not None
+            and journal[1:3] == self.stat
+        )
+        self.closed = self.resumed and journal[4] is not None
+        if self.resumed:
+            if self.closed:
+                self.sha256 = journal[4]
+            return journal[0], journal[3]
+        duplicate = Fingerprint.duplicate(self)
+        if duplicate is not None:
+            print(
+                "Identical to", duplicate, "already uploaded. Skipping",
+                self.src, file=sys.stderr, flush=True
             )
-            if req.status == 429:
-                print(
-                    "Upload server quota exceeded. Skipping", self.src,
-                    file=sys.stderr, flush=True
-                )
-                return
-            upload_token = req.data.decode("utf-8").strip()
-        # Done with the first API call and let the file uploader to proceed
-        upload_file(upload_token, self.src)
-        # Upload completed. Reconnect and submit the file.
-        # Close the last file
+            common.DATABASE.record_file(self.src, *self.stat, self.sha256)
+            return None
+        return None, Codec.choose(self.src)
+
+    def start(self, upload_token: str, encoding: str):
+        "Journal the start of a new upload"
+        common.DATABASE.start_upload(
+            self.src, upload_token, *self.stat, encoding
+        )
+
+    def restart(self, err: Exception) -> bool:
+        "Drop the journal of a resumed upload refused by the server"
+        if not self.resumed:
+            return False
+        # Server no longer accepts the journaled token. Start over.
+        print("Cannot resume", self.src, ":", err, file=sys.stderr, flush=True)
+        common.DATABASE.drop_upload(self.src)
+        return True
+
+    def retry(self, err: Exception) -> bool:
+        "Queue an interrupted upload again after a delay, return if queued"
+        self.attempt += 1
+        if self.attempt >= int(common.CONFIG["cloud"]["attempt"]):
+            return False
+        # Network dropped. Retry later from the journaled ranges.
+        print(
+            "Upload of", self.src, "interrupted:", err,
+            "Retrying in", round(self.delay, 1), "seconds.",
+            file=sys.stderr, flush=True
+        )
+        timer = threading.Timer(self.delay, QUEUE.put, (self,))
+        timer.daemon = True
+        timer.start()
+        self.delay = backoff(self.delay)
+        return True
+
+    def mismatch(self, status: str) -> bool:
+        "Drop the ranges stored wrong from the journal to send them again"
+        ranges = mismatched_ranges(status)
+        if ranges is None:
+            return False
+        self.attempt += 1
+        if self.attempt >= int(common.CONFIG["cloud"]["attempt"]):
+            raise ConnectionError("Checksum mismatch of "+self.src)
+        # Send the ranges stored wrong again on the same token
+        print(
+            "Checksum mismatch of", self.src, ":", status,
+            file=sys.stderr, flush=True
+        )
+        common.DATABASE.drop_chunks(self.src, ranges or [(0, self.stat[0])])
+        return True
+
+    def mark_closed(self):
+        "Journal the file as closed, to resume with its finalization"
+        common.DATABASE.close_upload(self.src, self.sha256)
+
+    def finish(self):
+        "Journal the upload as completed and count it for the run"
+        common.DATABASE.finish_upload(self.src, self.sha256)
+        common.DATABASE.add_content(
+            self.src, self.conf["id"], *self.fingerprint, self.sha256
+        )
+        common.DATABASE.increment_run(self.conf["id"])
+        print("File", self.src, "uploaded.", file=sys.stderr, flush=True)
+
+    def _get_token(
+        self, api: common.WebRequest, mapping: tuple, encoding: str = ""
+    ) -> tuple:
+        "Obtain an upload token and the encoding accepted, as token_reply"
+        # Start of file upload, obtain an upload token
+        req = api.request_form(
+            "cgi-bin/createrun.py", token_query(mapping, encoding)
+        )
+        return token_reply(req, self.src, encoding)
+
+    def _close(self, upload_token: str) -> str:
+        "Close the uploaded file with its SHA-256, return the status"
         req = common.WebRequest.request_file(
-            "POST",
-            "cgi-bin/upload.py",
-            headers={
-                "Content-Type": "application/x-www-form-urlencoded",
-                # "Accept": "application/json"
-            },
-            body=up.urlencode({
-                "session": upload_token,
-                "action": "close",
-                "format": src_format
-            }).encode("ascii")
+            **close_form(upload_token, self.src, self.sha256)
         )
         # The following is for restified enhancement of submit response
         # target_file = json.loads(req.data.decode("utf-8"))
-        target_file = {"status": req.data.decode("utf-8").strip()}
-        while target_file["status"].lower() == "finalizing":
-            req = common.WebRequest.request_file(
-                "POST",
-                "cgi-bin/upload.py",
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    # "Accept": "application/json"
-                },
-                body=up.urlencode(
-                    {"session": upload_token, "action": "finalize"}
-                ).encode("ascii")
-            )
-            target_file = {"status": req.data.decode("utf-8").strip()}
-            # target_file = json.loads(req.data.decode("utf-8"))
-            # if "init" not in target_file:
-            time.sleep(3)
-        target_file["name"] = target_file["status"]
-
-        # Report to webserver that the previous file has been uploaded.
-        with common.WebRequest() as api:
-            api.request(
-                "PUT",
-                os.path.join("rest/upload", mapping[0], upload_token),
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-                body=up.urlencode({
-                    "barcode": "fast5",
-                    "file": target_file["name"],
-                    "name": src_file
-                }).encode("ascii")
-            )
+        return file_reply(req, "Close of "+self.src)
+
+    def _submit(self, mapping: tuple, upload_token: str, status: str) -> bool:
+        "Report the closed file once finalized"
+        if status.lower() == "finalizing":
+            if FINALIZER is not None:
+                # Let the worker go on while the server finalizes
+                FINALIZER.add(SubmitTask(self, mapping, upload_token))
+                return None
+            status = wait_finalized(upload_token)
+        self._report(mapping, upload_token, status)
+        return True
 
+    def release(self, uploaded: bool):
+        "Release the quota reservation of the task"
+        if self.reserved:
+            self.reserved = False
+            QUOTA.release(self.conf["id"], uploaded)
+        if not uploaded:
+            for hook in UploadTask.give_up_hook:
+                hook(self.src)
+
+    def _report(self, mapping: tuple, upload_token: str, status: str):
+        "Report the finalized file and submit it for analysis"
+        with common.session() as api:
+            # Report to webserver that the previous file has been uploaded.
+            api.request(**report_form(mapping, upload_token, self.src, status))
             # Submit all uploaded file to pipeline for analysis
-            api.request_file(
-                "POST",
+            file_reply(api.request_form(
                 "cgi-bin/submitfast5.py",
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "Origin": common.WebRequest.webserver
-                },
-                body=up.urlencode({
-                    "session": api.token,
-                    "upload": upload_token,
-                    "id": mapping[0],
-                    "flowcell": self.conf["flowcell"],
-                    "kit": self.conf["kit"],
-                    "barcode": self.conf["barcode_kits"]
-                }).encode("ascii")
-            )
+                submit_query(upload_token, mapping, self.conf)
+            ), "Submission")
         # Upload successfully completed. Update the counter.
-        common.DATABASE.increment_run(self.conf["id"])
-        print("File", self.src, "uploaded.", file=sys.stderr, flush=True)
+        self.finish()
+
+
+def worker():
+    "Upload worker loop consuming QUEUE till the termination sentinel"
+    while True:
+        task = QUEUE.get()
+        if task is None:
+            break
+        try:
+            task.upload()
+        except Exception as err:  # pylint: disable=broad-except
+            print(
+                "Failed to process task for", task.src, ":", err,
+                file=sys.stderr, flush=True
+            )
+            if common.VERBOSE:
+                traceback.print_exc()